@@ -1,7 +1,8 @@
 #!/usr/bin/env python
+import json
 import logging
 from pathlib import Path
-from typing import Set, List, Dict
+from typing import List, Dict, Tuple, Optional, IO, Iterator, Iterable
 
 import numpy as np
 import pandas as pd
@@ -9,18 +10,35 @@ import typer
 from rich.console import Console
 from rich.logging import RichHandler
 
+# Number of matrix rows converted to dense TSV text at a time
+DENSE_BLOCK_SIZE = 1000
+# Number of Nextclade CSV/TSV rows parsed at a time
+NEXTCLADE_CHUNKSIZE = 10000
+NEXTCLADE_COLUMNS = ['seqName', 'aaSubstitutions', 'aaDeletions']
+NEXTCLADE_SEPARATORS = {'.csv': ';', '.tsv': '\t'}
+NDJSON_SUFFIXES = {'.ndjson', '.jsonl'}
 
-def main(nextclade_csv: Path, metadata_output: Path):
+
+def main(
+        nextclade_results: Path,
+        sparse_output: Path = typer.Option(Path('aa_mutation_matrix.npz'),
+                                           help='AA mutation matrix in sparse CSR format (NumPy .npz)'),
+        tsv_output: Optional[Path] = typer.Option(None, help='Optional dense AA mutation matrix TSV'),
+        chunksize: int = typer.Option(NEXTCLADE_CHUNKSIZE, help='Number of Nextclade CSV/TSV rows to parse at a time'),
+):
+    """Build AA mutation matrix from Nextclade CSV (";" delimited), TSV or NDJSON results"""
     init_logging()
-    df_nextclade = pd.read_table(nextclade_csv, sep=';', dtype=str, index_col=0)
-    aa_subs: pd.Series = df_nextclade['aaSubstitutions'].str.split(',')
-    aa_dels: pd.Series = df_nextclade['aaDeletions'].str.split(',')
-    sample_aas = sample_to_aa_mutations(aa_subs, aa_dels)
-    samples = list(sample_aas.keys())
-    unique_aas = get_sorted_aa_mutations(sample_aas)
-    arr_aas = fill_aa_mutation_matrix(sample_aas, samples, unique_aas)
-    dfaa = pd.DataFrame(arr_aas, index=samples, columns=unique_aas)
-    dfaa.to_csv(metadata_output, sep='\t')
+    logging.info(f'Reading AA substitutions and deletions from Nextclade results "{nextclade_results}"')
+    indptr, indices, samples, unique_aas = build_aa_mutation_matrix(iter_nextclade_aa_mutations(nextclade_results,
+                                                                                                 chunksize))
+    logging.info(f'Built AA mutation matrix of {len(samples)} samples by {len(unique_aas)} AA mutations '
+                 f'with {indices.size} AA mutations present.')
+    write_sparse_matrix(sparse_output, indptr, indices, samples, unique_aas)
+    logging.info(f'Wrote sparse AA mutation matrix to "{sparse_output}"')
+    if tsv_output:
+        with open(tsv_output, 'wb') as fout:
+            write_dense_tsv(fout, indptr, indices, samples, unique_aas)
+        logging.info(f'Wrote dense AA mutation matrix to "{tsv_output}"')
 
 
 def init_logging():
@@ -35,40 +53,161 @@ def init_logging():
     )
 
 
-def sample_to_aa_mutations(
-        aa_subs: pd.Series,
-        aa_dels: pd.Series
-) -> Dict[str, Set[str]]:
-    sample_aas = {}
-    for sample, aa_sub, aa_del in zip(aa_subs.index, aa_subs, aa_dels):
-        aas = [] if not isinstance(aa_sub, list) else aa_sub
-        aad = [] if not isinstance(aa_del, list) else aa_del
-        sample_aas[sample] = set(aas) | set(aad)
-    return sample_aas
+def iter_nextclade_aa_mutations(path: Path, chunksize: int = NEXTCLADE_CHUNKSIZE) -> Iterator[Tuple[str, List[str]]]:
+    """Get AA substitutions and deletions of each sample in Nextclade CSV, TSV or NDJSON results
+
+    CSV and TSV results are parsed in chunks of rows with only the sequence name, AA substitutions and AA deletions
+    columns, and NDJSON results one line at a time, so that memory use does not depend on the number of results.
+    """
+    if path.suffix in NDJSON_SUFFIXES:
+        yield from iter_ndjson_aa_mutations(path)
+        return
+    sep = NEXTCLADE_SEPARATORS.get(path.suffix, ';')
+    for df in pd.read_csv(path, sep=sep, usecols=NEXTCLADE_COLUMNS, dtype=str, chunksize=chunksize):
+        for sample, aa_sub, aa_del in zip(df['seqName'], df['aaSubstitutions'], df['aaDeletions']):
+            aas = [] if not isinstance(aa_sub, str) else aa_sub.split(',')
+            if isinstance(aa_del, str):
+                aas += aa_del.split(',')
+            yield sample, aas
+
+
+def iter_ndjson_aa_mutations(path: Path) -> Iterator[Tuple[str, List[str]]]:
+    """Get AA substitutions and deletions from Nextclade NDJSON results as "gene:{ref}{pos}{alt}" strings"""
+    with open(path) as fh:
+        for line in fh:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            aas = [format_aa_mutation(x) for x in result.get('aaSubstitutions') or []]
+            aas += [format_aa_mutation(x, deletion=True) for x in result.get('aaDeletions') or []]
+            yield result['seqName'], aas
+
+
+def format_aa_mutation(aa: Dict, deletion: bool = False) -> str:
+    """Format a Nextclade NDJSON AA mutation like in Nextclade CSV/TSV output (e.g. "S:N501Y", "S:Y144-")
+
+    Handles field names of different Nextclade versions. Codon positions are 0-based in NDJSON output.
+    """
+    gene = aa.get('cdsName', aa.get('gene'))
+    pos = aa.get('pos', aa.get('codon')) + 1
+    ref = aa.get('refAa', aa.get('refAA'))
+    alt = '-' if deletion else aa.get('qryAa', aa.get('queryAA'))
+    return f'{gene}:{ref}{pos}{alt}'
+
+
+def build_aa_mutation_matrix(
+        sample_aas: Iterable[Tuple[str, List[str]]],
+) -> Tuple[np.ndarray, np.ndarray, List[str], List[str]]:
+    """Build a binary AA mutation matrix in compressed sparse row (CSR) format
+
+    Each AA mutation is assigned a column with a dict lookup as it is first seen, then columns are renumbered in
+    sorted AA mutation order. Only the (row, column) indices of present AA mutations are stored. If a sample occurs
+    more than once, its last AA mutations are kept in the row of its first occurrence and AA mutations only found in
+    replaced rows are dropped.
+
+    Arguments:
+        sample_aas: Sample and its AA mutations
+
+    Returns:
+        CSR row pointer and column index arrays, the sample for each row and the AA mutation for each column
+    """
+    aa_columns: Dict[str, int] = {}
+    sample_rows: Dict[str, int] = {}
+    row_cols = []
+    for sample, aas in sample_aas:
+        cols = np.unique(np.fromiter((aa_columns.setdefault(aa, len(aa_columns)) for aa in aas), dtype=np.int64))
+        row = sample_rows.setdefault(sample, len(sample_rows))
+        if row == len(row_cols):
+            row_cols.append(cols)
+        else:
+            row_cols[row] = cols
+    indptr = np.zeros(len(row_cols) + 1, dtype=np.int64)
+    np.cumsum([cols.size for cols in row_cols], out=indptr[1:])
+    indices = np.concatenate(row_cols) if row_cols else np.zeros(0, dtype=np.int64)
+    # only keep columns of AA mutations present in the final rows
+    used = np.zeros(len(aa_columns), dtype=bool)
+    used[indices] = True
+    column_aas = list(aa_columns)
+    unique_aas = sorted(column_aas[i] for i in np.flatnonzero(used).tolist())
+    renumber = np.full(len(aa_columns), -1, dtype=np.int64)
+    renumber[[aa_columns[aa] for aa in unique_aas]] = np.arange(len(unique_aas))
+    indices = renumber[indices]
+    rows = np.repeat(np.arange(len(row_cols)), np.diff(indptr))
+    indices = indices[np.lexsort((indices, rows))]
+    return indptr, indices, list(sample_rows), unique_aas
 
 
-def fill_aa_mutation_matrix(
-        sample_aas: Dict[str, Set[str]],
+def write_sparse_matrix(
+        path: Path,
+        indptr: np.ndarray,
+        indices: np.ndarray,
         samples: List[str],
         unique_aas: List[str]
-) -> np.ndarray:
-    """Fill AA mutation matrix with 1 when AA mutation present in sample"""
-    arr_aas = np.zeros((len(sample_aas), len(unique_aas)), dtype='uint8')
-    for i, sample in enumerate(samples):
-        aas = sample_aas[sample]
-        for j, aa in enumerate(unique_aas):
-            if aa in aas:
-                arr_aas[i, j] = 1
-    return arr_aas
-
-
-def get_sorted_aa_mutations(sample_aas: Dict[str, Set[str]]) -> List[str]:
-    unique_aas = set()
-    for aas in sample_aas.values():
-        unique_aas |= aas
-    unique_aas = list(unique_aas)
-    unique_aas.sort()
-    return unique_aas
+) -> None:
+    """Write CSR matrix arrays with row and column names to a NumPy .npz file
+
+    The matrix can be loaded with `scipy.sparse.csr_matrix((np.ones(indices.size), indices, indptr), shape)`
+    or with `read_aa_mutation_matrix`.
+    """
+    with open(path, 'wb') as fout:
+        np.savez_compressed(
+            fout,
+            indptr=indptr,
+            indices=indices,
+            shape=np.array([len(samples), len(unique_aas)], dtype=np.int64),
+            samples=np.array(samples, dtype=str),
+            mutations=np.array(unique_aas, dtype=str),
+        )
+
+
+def write_dense_tsv(
+        fout: IO[bytes],
+        indptr: np.ndarray,
+        indices: np.ndarray,
+        samples: List[str],
+        unique_aas: List[str],
+        block_size: int = DENSE_BLOCK_SIZE
+) -> None:
+    """Write a CSR matrix as a dense TSV of 0 and 1 values in blocks of rows
+
+    Each block of rows is expanded into a byte array of tab-separated digits so that memory use is bounded by
+    the block size rather than the number of samples.
+    """
+    fout.write(('\t' + '\t'.join(unique_aas) + '\n').encode())
+    for start in range(0, len(samples), block_size):
+        end = min(start + block_size, len(samples))
+        block = encode_dense_rows(indptr, indices, np.arange(start, end), len(unique_aas))
+        fout.write(b''.join(sample.encode() + row.tobytes() + b'\n'
+                            for sample, row in zip(samples[start:end], block)))
+
+
+def encode_dense_rows(indptr: np.ndarray, indices: np.ndarray, rows: np.ndarray, n_cols: int) -> np.ndarray:
+    """Encode rows of a CSR matrix as a byte array with a tab and a 0 or 1 digit for each column"""
+    counts = indptr[rows + 1] - indptr[rows]
+    block_rows = np.repeat(np.arange(rows.size), counts)
+    offsets = np.arange(block_rows.size) - np.repeat(np.cumsum(counts) - counts, counts)
+    cols = indices[np.repeat(indptr[rows], counts) + offsets]
+    block = np.empty((rows.size, 2 * n_cols), dtype=np.uint8)
+    block[:, 0::2] = ord('\t')
+    block[:, 1::2] = ord('0')
+    block[block_rows, 2 * cols + 1] = ord('1')
+    return block
+
+
+def read_sparse_matrix(path: Path) -> Tuple[np.ndarray, np.ndarray, List[str], List[str]]:
+    """Read CSR row pointer and column index arrays, samples and AA mutations written by `write_sparse_matrix`"""
+    with np.load(path) as npz:
+        return npz['indptr'], npz['indices'], npz['samples'].tolist(), npz['mutations'].tolist()
+
+
+def read_aa_mutation_matrix(path: Path) -> pd.DataFrame:
+    """Read a sparse (.npz) or dense (TSV) AA mutation matrix as a dense DataFrame indexed by sample"""
+    if path.suffix != '.npz':
+        return pd.read_table(path, index_col=0)
+    indptr, indices, samples, unique_aas = read_sparse_matrix(path)
+    arr = np.zeros((len(samples), len(unique_aas)), dtype='uint8')
+    arr[np.repeat(np.arange(len(samples)), np.diff(indptr)), indices] = 1
+    return pd.DataFrame(arr, index=samples, columns=unique_aas)
 
 
 if __name__ == '__main__':
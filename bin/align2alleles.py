@@ -1,99 +1,238 @@
 #!/usr/bin/env python3
 
-import pysam
 import sys
 import argparse
-import collections
+import shutil
+import tempfile
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+
+from sequence_io import UPPER_TABLE, imap_ordered, iter_fasta_blocks, parse_fasta_block
+
+# number of MSA sequences encoded into a uint8 matrix at a time
+CHUNK_SIZE = 1000
+N_BASE = ord("N")
+ACGT = np.frombuffer(b"ACGT", dtype=np.uint8)
+# output buffer size in bytes
+BUFFER_SIZE = 1 << 20
+
+# compact sparse binary variant list readable with R readBin:
+# magic, int32 format version, number of samples and number of variant calls,
+# null-terminated sample names, then one column after another of
+# int32 0-based sample index, int32 1-based position, uint8 ref allele, uint8 alt allele
+# and int32 number of samples with allele. All integers are little-endian.
+SPARSE_MAGIC = b"A2AS"
+SPARSE_VERSION = 1
+SPARSE_DTYPES = ["<i4", "<i4", "u1", "u1", "<i4"]
 
 # write results in matrix form where rows are samples
 # and columns are variant positions
-def write_result_matrix(variant_positions, sequences):
+def write_result_matrix(out, variant_positions, chunks):
     # print header
     # +1 is to report 1-based coordinates
-    print("\t".join(["strain"] + [str(i + 1) for i in variant_positions]))
-
-    for s in sequences:
-        out = list()
-        out.append(s[0])
-
-        for i in variant_positions:
-            out.append(str(s[1][i]))
-
-        print("\t".join(out))
+    out.write("\t".join(["strain"] + [str(i + 1) for i in variant_positions]) + "\n")
+
+    for names, matrix in chunks:
+        alleles = matrix[:, variant_positions]
+        lines = list()
+        for name, row in zip(names, alleles):
+            lines.append(name + "\t" + "\t".join(row.tobytes().decode()) + "\n")
+        out.write("".join(lines))
+
+# get the non-reference alleles at variant positions for each chunk of sequences
+def iter_variant_calls(variant_positions, counts, chunks, reference):
+    reference_alleles = reference[variant_positions]
+    for names, matrix in chunks:
+        alleles = matrix[:, variant_positions]
+        # row-major order of non-reference alleles is the same as looping over samples then positions
+        rows, cols = np.nonzero(alleles != reference_alleles)
+        alts = alleles[rows, cols]
+        positions = variant_positions[cols]
+        yield names, rows, positions, reference[positions], alts, counts[positions, alts]
 
 # write results as a TSV file with one row per variant found in a sample
-def write_variant_list(variant_positions, counters, sequences, reference_sample):
-    print("\t".join(["name", "pos", "ref_allele", "alt_allele", "samples_with_allele"]))
-    for s in sequences:
-        for i in variant_positions:
-            b = s.sequence[i]
-            if b != reference_sample.sequence[i]:
-                print("\t".join([s.name, str(i+1), reference_sample.sequence[i], b, str(counters[i][b])]))
-
-#
-#
-#
-parser = argparse.ArgumentParser()
-parser.add_argument('--min-allele-count', default=1, type=int)
-parser.add_argument('--mode', default="variant_list", type=str)
-parser.add_argument('--reference-name', default="Wuhan-Hu-1/2019", type=str)
-args, extra = parser.parse_known_args()
-
-fa = pysam.FastxFile(extra[0])
-sequences = list()
-
-# read all sequence from the MSA
-alen = -1
-for r in fa:
-    if alen == -1:
-        alen = len(r.sequence)
-    r.sequence = r.sequence.upper()
-    sequences.append(r)
-
-# discover variant columns
-counters = list()
-for i in range(0, alen):
-    counters.append(collections.Counter())
-
-
-
-#
-reference_sample = None
-
-# count the number of occurrences of each base at each position
-for s in sequences:
-    if s.name == args.reference_name:
-        reference_sample = s
-    for i in range(0, alen):
-        b = s.sequence[i]
-        counters[i].update(b)
-
-if reference_sample is None:
-    sys.stderr.write("error: reference sample could not be found")
-    sys.exit(1)
-
-# write results
-if args.mode == "variant_list":
-    # determine which positions have a SNP
-    variant_positions = list()
-    for i in range(0, alen):
-        supported_bases = list()
-        for b in counters[i]:
-            c = counters[i][b]
-            if b != "N" and c >= args.min_allele_count:
-                supported_bases.append(b)
-
-        if len(supported_bases) > 1:
-            variant_positions.append(i)
-    write_variant_list(variant_positions, counters, sequences, reference_sample)
-
-elif args.mode == "variant_frequency":
-    for i in range(0, alen):
-        reference_base = reference_sample.sequence[i]
-        for b in ("A", "C", "G", "T"):
-            if b == reference_base:
-                continue
-            c = counters[i][b]
-            if c > 0:
-                out = [ reference_name, str(i + 1), reference_base, b, counters[i][reference_base], counters[i][b] ]
-                print("\t".join([str(x) for x in out]))
+def write_variant_list(out, variant_calls, sparse_writer=None):
+    out.write("\t".join(["name", "pos", "ref_allele", "alt_allele", "samples_with_allele"]) + "\n")
+    for names, rows, positions, refs, alts, samples_with_allele in variant_calls:
+        lines = list()
+        for row, i, ref, alt, c in zip(rows.tolist(), positions.tolist(), refs.tolist(), alts.tolist(),
+                                       samples_with_allele.tolist()):
+            lines.append(f"{names[row]}\t{i + 1}\t{chr(ref)}\t{chr(alt)}\t{c}\n")
+        out.write("".join(lines))
+        if sparse_writer is not None:
+            sparse_writer.write(names, rows, positions, refs, alts, samples_with_allele)
+
+# write allele frequencies for each non-reference A, C, G or T allele found at each position
+def write_variant_frequency(out, counts, reference, reference_name):
+    alt_counts = counts[:, ACGT]
+    positions, bases = np.nonzero((ACGT != reference[:, None]) & (alt_counts > 0))
+    reference_counts = counts[positions, reference[positions]]
+    lines = list()
+    for i, b, reference_count, alt_count in zip(positions.tolist(), ACGT[bases].tolist(), reference_counts.tolist(),
+                                                alt_counts[positions, bases].tolist()):
+        lines.append(f"{reference_name}\t{i + 1}\t{chr(reference[i])}\t{chr(b)}\t{reference_count}\t{alt_count}\n")
+    out.write("".join(lines))
+
+# write variant calls in the compact sparse binary format described by SPARSE_MAGIC,
+# spooling each column to a temporary file so that memory use does not grow with the number of calls
+class SparseAlleleWriter:
+    def __init__(self, path):
+        self.path = path
+        self.names = list()
+        self.n_calls = 0
+        self.columns = [tempfile.TemporaryFile() for _ in SPARSE_DTYPES]
+
+    def write(self, names, rows, positions, refs, alts, samples_with_allele):
+        offset = len(self.names)
+        self.names.extend(names)
+        values = (rows + offset, positions + 1, refs, alts, samples_with_allele)
+        for fh, column, dtype in zip(self.columns, values, SPARSE_DTYPES):
+            fh.write(np.asarray(column, dtype=dtype).tobytes())
+        self.n_calls += len(rows)
+
+    def close(self):
+        with open(self.path, "wb") as out:
+            out.write(SPARSE_MAGIC)
+            out.write(np.array([SPARSE_VERSION, len(self.names), self.n_calls], dtype="<i4").tobytes())
+            out.write(b"".join(name.encode() + b"\0" for name in self.names))
+            for fh in self.columns:
+                fh.seek(0)
+                shutil.copyfileobj(fh, out)
+                fh.close()
+
+# read MSA sequences in chunks of uppercased sequences encoded as a uint8 matrix
+# with one row per sequence and one column per alignment position
+def read_msa_chunks(path, chunk_size=CHUNK_SIZE):
+    alen = -1
+    names = list()
+    rows = list()
+    for name, seq in read_fasta(path):
+        if alen == -1:
+            alen = len(seq)
+        if len(seq) < alen:
+            sys.stderr.write(f"error: sequence {name} is shorter than alignment length {alen}")
+            sys.exit(1)
+        names.append(name)
+        rows.append(seq[:alen])
+        if len(rows) == chunk_size:
+            yield names, encode_rows(rows, alen)
+            names = list()
+            rows = list()
+    if rows:
+        yield names, encode_rows(rows, alen)
+
+# read FASTA records as name (header up to the first whitespace) and uppercased sequence bytes
+def read_fasta(path):
+    with open(path, "rb") as fh:
+        for block in iter_fasta_blocks(fh):
+            for header, seq in parse_fasta_block(block):
+                name = header.split(None, 1)[0] if header.strip() else ""
+                yield name, seq.translate(UPPER_TABLE)
+
+def encode_rows(rows, alen):
+    return np.frombuffer(b"".join(rows), dtype=np.uint8).reshape(len(rows), alen)
+
+# count the number of occurrences of each base (byte value) present in a chunk at each position.
+# Only columns for present bases are returned to keep results passed back from worker processes small
+def count_alleles(matrix):
+    present = np.flatnonzero(np.bincount(matrix.ravel(), minlength=256))
+    counts = np.empty((matrix.shape[1], present.size), dtype=np.int32)
+    for j, b in enumerate(present):
+        counts[:, j] = np.count_nonzero(matrix == b, axis=0)
+    return present, counts
+
+# determine which positions have more than one supported non-N base
+def find_variant_positions(counts, min_allele_count):
+    supported = (counts > 0) & (counts >= min_allele_count)
+    supported[:, N_BASE] = False
+    return np.flatnonzero(supported.sum(axis=1) > 1)
+
+# count alleles in chunks of MSA sequences, optionally in parallel worker processes,
+# keeping at most a few chunks in memory at a time
+def count_msa_alleles(path, reference_name, chunk_size=CHUNK_SIZE, threads=1):
+    counts = None
+    reference = None
+    chunks = read_msa_chunks(path, chunk_size)
+    count_chunk = partial(count_chunk_alleles, reference_name=reference_name)
+    if threads > 1:
+        pool = Pool(threads)
+        chunk_counts = imap_ordered(pool, count_chunk, chunks, max_pending=2 * threads)
+    else:
+        pool = None
+        chunk_counts = map(count_chunk, chunks)
+    try:
+        for (present, c), chunk_reference in chunk_counts:
+            if counts is None:
+                counts = np.zeros((c.shape[0], 256), dtype=np.int64)
+            counts[:, present] += c
+            if chunk_reference is not None:
+                reference = chunk_reference
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return counts, reference
+
+# count alleles in a chunk of MSA sequences and get the reference sequence if it is in the chunk
+def count_chunk_alleles(chunk, reference_name):
+    names, matrix = chunk
+    return count_alleles(matrix), find_reference(names, matrix, reference_name)
+
+# get the last sequence in a chunk with the reference name
+def find_reference(names, matrix, reference_name):
+    reference = None
+    for row, name in enumerate(names):
+        if name == reference_name:
+            reference = matrix[row].copy()
+    return reference
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--min-allele-count', default=1, type=int)
+    parser.add_argument('--mode', default="variant_list", type=str)
+    parser.add_argument('--reference-name', default="Wuhan-Hu-1/2019", type=str)
+    parser.add_argument('--chunk-size', default=CHUNK_SIZE, type=int,
+                        help="number of MSA sequences to read and count at a time")
+    parser.add_argument('--threads', default=1, type=int,
+                        help="number of worker processes for counting alleles")
+    parser.add_argument('--output', default="-", type=str,
+                        help="output TSV path (default: stdout)")
+    parser.add_argument('--sparse-output', default=None, type=str,
+                        help="output path for variant list in compact sparse binary format (variant_list mode)")
+    args, extra = parser.parse_known_args()
+    if args.mode not in ("variant_list", "variant_frequency", "matrix"):
+        sys.stderr.write(f"error: unknown mode {args.mode}. Must be one of variant_list, variant_frequency or matrix")
+        sys.exit(1)
+
+    # first pass: count the number of occurrences of each base at each position
+    counts, reference = count_msa_alleles(extra[0], args.reference_name, args.chunk_size, args.threads)
+
+    if reference is None:
+        sys.stderr.write("error: reference sample could not be found")
+        sys.exit(1)
+
+    # write results
+    if args.output == "-":
+        out = open(sys.stdout.fileno(), "w", buffering=BUFFER_SIZE, closefd=False)
+    else:
+        out = open(args.output, "w", buffering=BUFFER_SIZE)
+    with out:
+        if args.mode == "variant_frequency":
+            write_variant_frequency(out, counts, reference, args.reference_name)
+        else:
+            variant_positions = find_variant_positions(counts, args.min_allele_count)
+            # second pass: re-read the MSA to write the alleles at variant positions
+            chunks = read_msa_chunks(extra[0], args.chunk_size)
+            if args.mode == "matrix":
+                write_result_matrix(out, variant_positions, chunks)
+            else:
+                variant_calls = iter_variant_calls(variant_positions, counts, chunks, reference)
+                sparse_writer = SparseAlleleWriter(args.sparse_output) if args.sparse_output else None
+                write_variant_list(out, variant_calls, sparse_writer)
+                if sparse_writer is not None:
+                    sparse_writer.close()
+
+if __name__ == "__main__":
+    main()
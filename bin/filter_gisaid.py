@@ -1,10 +1,16 @@
 #!/usr/bin/env python
+import atexit
+import hashlib
+import io
 import logging
+import os
 import re
 import sys
 import tarfile
+from contextlib import contextmanager, ExitStack
 from pathlib import Path
-from typing import Iterator, Tuple, Optional, IO, Set, Dict, Any
+from typing import Iterator, Tuple, Optional, IO, Set, Dict, Any, List, ContextManager, \
+    NamedTuple
 
 import numpy as np
 import pandas as pd
@@ -13,6 +19,25 @@ from Bio.SeqIO.FastaIO import SimpleFastaParser
 from rich.console import Console
 from rich.logging import RichHandler
 
+from lineage_sampling import stratified_sample, n_content_weights
+from sequence_io import FASTA_BLOCK_SIZE, detect_compression, open_decompressed, peek_stream, read_exactly, \
+    PrefixedStream, iter_fasta_blocks, parse_fasta_block, sequence_stats, imap_ordered
+
+# Normalized GISAID metadata columns required for filtering sequences by metadata
+FILTER_COLUMNS = ['Collection_date', 'Location', 'Pango_lineage', 'N_Content']
+# Columns "Location" values are split into
+LOCATION_COLUMNS = ['region', 'country', 'division', 'city']
+# Optional columns of --batch-queries table named after the corresponding command-line options
+BATCH_QUERY_COLUMNS = ['pangolin_lineages', 'country', 'region', 'date_start', 'date_end', 'max_gisaid_seqs']
+# Formats of full and partial GISAID collection dates tried in order
+COLLECTION_DATE_FORMATS = ['%Y-%m-%d', '%Y-%m', '%Y']
+
+SEQUENCE_STATS_COLUMNS = ['strain', 'length', 'n_ambiguous', 'n_N', 'n_gaps', 'passed_filters']
+TAR_HEADER_SIZE = 512
+
+# Normalized strain name, (length, ambiguous, N, gap counts), passed filters, sequence if passed filters
+CheckedSeq = Tuple[str, Tuple[int, int, int, int], bool, Optional[bytes]]
+
 
 def main(
         user_fasta: Path,
@@ -42,7 +67,36 @@ def main(
         nextstrain_metadata: Path = typer.Option(Path('gisaid_metadata.nextstrain.tsv'),
                                                  help='Filtered GISAID metadata table for Nextstrain analysis.'),
         statistics_output: Path = typer.Option(Path('gisaid_stats.json'),
-                                               help='GISAID filtering stats.')
+                                               help='GISAID filtering stats.'),
+        sequence_stats_output: Optional[Path] = typer.Option(None,
+                                                             help='Per-sequence QC stats (length, ambiguous bases, '
+                                                                  'N and gap counts) for metadata filtered GISAID '
+                                                                  'sequences.'),
+        cache_dir: Optional[Path] = typer.Option(None,
+                                                 help='Directory to cache the parsed GISAID metadata table and the '
+                                                      'GISAID sequences FASTA strain index in so that later runs '
+                                                      'against the same GISAID files can skip decompressing, parsing '
+                                                      'and scanning them.'),
+        low_memory: bool = typer.Option(False,
+                                        help='Stream GISAID metadata in chunks, only parsing the columns required for '
+                                             'filtering, then read full rows only for selected sequences.'),
+        metadata_chunksize: int = typer.Option(500000, help='Number of GISAID metadata rows per chunk in '
+                                                            '--low-memory mode.'),
+        threads: int = typer.Option(1, help='Number of processes to use for reading and checking GISAID sequences. '
+                                            'Compressed GISAID sequences are decompressed with one thread and '
+                                            'checked by the remaining processes.'),
+        seed: Optional[int] = typer.Option(None, help='Random seed for down-sampling GISAID sequences.'),
+        batch_queries: Optional[Path] = typer.Option(None,
+                                                     help='CSV or tab-delimited table of GISAID filtering queries, one '
+                                                          'per row, with a "name" column and optional '
+                                                          '"pangolin_lineages", "country", "region", "date_start", '
+                                                          '"date_end" and "max_gisaid_seqs" columns. Blank values '
+                                                          'default to the corresponding option. All queries are '
+                                                          'evaluated against one read of the GISAID metadata and '
+                                                          'sequences and outputs are written to a directory per '
+                                                          'query under --batch-outdir.'),
+        batch_outdir: Path = typer.Option(Path('gisaid_batch'),
+                                          help='Output directory for per-query outputs in --batch-queries mode.')
 ):
     init_logging()
     df_pangolin = pd.read_csv(pangolin_report, dtype=str)
@@ -51,107 +105,334 @@ def main(
     if 'None' in sample_lineages:
         sample_lineages.remove('None')
     logging.info(f'{len(sample_lineages)} unique Pangolin lineages for user sequences: {sample_lineages}')
-    df_gisaid = read_gisaid_metadata(gisaid_tsv)
-    logging.info(f'Read GISAID metadata table from "{gisaid_tsv}"; '
-                 f'{df_gisaid.shape[0]} rows and {df_gisaid.shape[1]} columns')
-    gisaid_lineages = df_gisaid['Pango_lineage']
-    if pangolin_lineages:
-        pangolin_lineages = set(pangolin_lineages.split(','))
-        logging.info(f'Filtering for specified Pangolin lineages: {pangolin_lineages}')
-        sample_lineages |= pangolin_lineages
-    mask: pd.Series = gisaid_lineages.isin(sample_lineages)
-    n_gisaid_matching_lineage = int(mask.sum())
-    logging.info(f'{n_gisaid_matching_lineage} GISAID sequences matching lineages: {sample_lineages}')
-    if date_start:
-        dt_start: pd.Timestamp = pd.to_datetime(date_start, errors='coerce')
-        if not pd.isna(dt_start):
-            collection_datetimes: pd.Series = pd.to_datetime(df_gisaid['Collection_date'], errors='coerce')
-            dt_start_mask: pd.Series = (collection_datetimes >= dt_start)
-            mask = mask & dt_start_mask
-            logging.info(f'{mask.sum()} GISAID sequences filtered starting {dt_start}. {dt_start_mask.sum()}')
-        else:
-            logging.info(f'Could not parse datetime from "{date_start}". No date filtering applied.')
-
-    if date_end:
-        dt_end: pd.Timestamp = pd.to_datetime(date_end, errors='coerce')
-        if not pd.isna(dt_end):
-            collection_datetimes: pd.Series = pd.to_datetime(df_gisaid['Collection_date'], errors='coerce')
-            dt_end_mask: pd.Series = (collection_datetimes <= dt_end)
-            mask = mask & dt_end_mask
-            logging.info(f'{mask.sum()} GISAID sequences filtered ending {dt_end}.')
-        else:
-            logging.info(f'Could not parse datetime from "{date_start}". No date filtering applied.')
-
-    if country:
-        if ',' in country:
-            countries = [x.strip() for x in country.split(',') if x.strip() != '']
-            mask = mask & df_gisaid['country'].isin(countries)
-            logging.info(f'{mask.sum()} GISAID sequences after filtering for countries: {countries}')
-        else:
-            mask = mask & df_gisaid['country'].str.contains(country)
-            logging.info(f'{mask.sum()} GISAID sequences after filtering for country "{country}"')
-    if region:
-        if ',' in region:
-            regions = [x.strip() for x in region.split(',') if x.strip() != '']
-            mask = mask & df_gisaid['region'].isin(regions)
-            logging.info(f'{mask.sum()} GISAID sequences after filtering for regions: "{regions}"')
-        else:
-            mask = mask & df_gisaid['region'].str.contains(region)
-            logging.info(f'{mask.sum()} GISAID sequences after filtering for region "{region}"')
-    df_subset: pd.DataFrame = df_gisaid.loc[mask, :]
-    # drop duplicate entries of df_subset before filtering/sampling
-    df_subset = df_subset[~df_subset.index.duplicated()]  # default keep first occurrence
-    logging.info(f'{df_subset.shape[0]} interest strains found ')
-    if df_subset.index.size > max_gisaid_seqs:
-        logging.warning(f'There are {df_subset.index.size} GISAID sequences selected by metadata. '
-                        f'Down-sampling to {max_gisaid_seqs}')
-        sampled_gisaid = sampling_gisaid(df_subset, max_gisaid_seqs)
-        df_subset = df_subset.loc[sampled_gisaid, :]
-    metadata_filtered_sequences = set(df_subset.index)
-    if not metadata_filtered_sequences:
+    default_query = MetadataQuery(
+        name='',
+        lineages=sample_lineages,
+        dt_start=parse_date_option(date_start),
+        dt_end=parse_date_option(date_end),
+        country=country,
+        region=region,
+        max_gisaid_seqs=max_gisaid_seqs,
+    )
+    if batch_queries:
+        queries = read_batch_queries(batch_queries, default_query, pangolin_lineages)
+        logging.info(f'Read {len(queries)} GISAID filtering queries from "{batch_queries}"')
+        query_outputs = [
+            QueryOutputs(
+                fasta=batch_outdir / query.name / fasta_output.name,
+                filtered_metadata=batch_outdir / query.name / filtered_metadata.name,
+                nextstrain_metadata=batch_outdir / query.name / nextstrain_metadata.name,
+                statistics=batch_outdir / query.name / statistics_output.name if statistics_output else None,
+                sequence_stats=batch_outdir / query.name / sequence_stats_output.name if sequence_stats_output else None,
+            ) for query in queries
+        ]
+        for outputs in query_outputs:
+            outputs.fasta.parent.mkdir(parents=True, exist_ok=True)
+    else:
+        if pangolin_lineages:
+            pangolin_lineages = set(pangolin_lineages.split(','))
+            logging.info(f'Filtering for specified Pangolin lineages: {pangolin_lineages}')
+            default_query = default_query._replace(lineages=sample_lineages | pangolin_lineages)
+        queries = [default_query]
+        query_outputs = [QueryOutputs(fasta_output, filtered_metadata, nextstrain_metadata,
+                                      statistics_output, sequence_stats_output)]
+    for query in queries:
+        logging.info(f'Filtering GISAID metadata{query_label(query)} for lineages={query.lineages}, '
+                     f'date_start={query.dt_start}, date_end={query.dt_end}, country={query.country}, '
+                     f'region={query.region}')
+    if low_memory:
+        logging.info(f'Streaming GISAID metadata from "{gisaid_tsv}" in chunks of {metadata_chunksize} rows, '
+                     f'parsing only the columns required for filtering.')
+        query_results = scan_gisaid_metadata(gisaid_tsv, queries, chunksize=metadata_chunksize, cache_dir=cache_dir)
+    else:
+        df_gisaid = read_gisaid_metadata(gisaid_tsv, cache_dir=cache_dir)
+        logging.info(f'Read GISAID metadata table from "{gisaid_tsv}"; '
+                     f'{df_gisaid.shape[0]} rows and {df_gisaid.shape[1]} columns')
+        df_filter = metadata_filter_columns(df_gisaid)
+        n_total_gisaid_lineages = df_filter['Pango_lineage'].nunique(dropna=False)
+        query_results = []
+        for query in queries:
+            lineage_mask, mask = metadata_filter_mask(df_filter, query.lineages, query.dt_start, query.dt_end,
+                                                      query.country, query.region)
+            query_results.append((
+                df_gisaid.loc[mask.values, :],
+                dict(
+                    n_total_gisaid_sequences=df_gisaid.shape[0],
+                    n_total_gisaid_lineages=n_total_gisaid_lineages,
+                    n_gisaid_matching_lineage=int(lineage_mask.sum()),
+                )
+            ))
+        del df_gisaid, df_filter
+    df_subsets = []
+    lineage_counts = []
+    for query, (df_subset, metadata_stats) in zip(queries, query_results):
+        logging.info(f'{metadata_stats["n_gisaid_matching_lineage"]} GISAID sequences matching lineages'
+                     f'{query_label(query)}: {query.lineages}')
+        logging.info(f'{df_subset.shape[0]} GISAID sequences after filtering by metadata{query_label(query)}')
+        lineage_counts.append(get_lineage_counts(df_subset))
+        # drop duplicate entries of df_subset before filtering/sampling
+        df_subset = df_subset[~df_subset.index.duplicated()]  # default keep first occurrence
+        logging.info(f'{df_subset.shape[0]} interest strains found{query_label(query)}')
+        if df_subset.index.size > query.max_gisaid_seqs:
+            logging.warning(f'There are {df_subset.index.size} GISAID sequences selected by metadata'
+                            f'{query_label(query)}. Down-sampling to {query.max_gisaid_seqs}')
+            sampled_gisaid = sampling_gisaid(df_subset, query.max_gisaid_seqs, seed=seed)
+            df_subset = df_subset.loc[df_subset.index.isin(sampled_gisaid), :]
+        if df_subset.empty and len(queries) > 1:
+            logging.warning(f'No GISAID sequences found matching filters{query_label(query)}!')
+        df_subsets.append(df_subset)
+    metadata_filtered_sequences = [set(df_subset.index) for df_subset in df_subsets]
+    all_metadata_filtered_sequences = set().union(*metadata_filtered_sequences)
+    if not all_metadata_filtered_sequences:
         logging.error(f'No GISAID sequences found matching filters!')
         sys.exit(1)
-    logging.info(f'Writing output FASTA with up to {len(metadata_filtered_sequences)} metadata filtered sequences to '
-                 f'"{fasta_output}". Performing additional filtering for sequences with up to {max_ambig} ambiguous '
-                 f'bases and length between {min_length} and {max_length}.')
-    keep_samples: Set[str] = write_fasta(
-        fasta_output,
+    if low_memory:
+        logging.info(f'Reading full GISAID metadata rows for {len(all_metadata_filtered_sequences)} '
+                     f'selected sequences')
+        df_rows = read_gisaid_metadata_rows(gisaid_tsv, all_metadata_filtered_sequences,
+                                            chunksize=metadata_chunksize, cache_dir=cache_dir)
+        df_subsets = [df_rows.loc[df_rows.index.isin(strains), :] for strains in metadata_filtered_sequences]
+        del df_rows
+    logging.info(f'Writing output FASTA with up to {len(all_metadata_filtered_sequences)} metadata filtered '
+                 f'sequences to {", ".join(f"{x.fasta}" for x in query_outputs)}. Performing additional filtering '
+                 f'for sequences with up to {max_ambig} ambiguous bases and length between {min_length} and '
+                 f'{max_length}.')
+    query_keep_samples: List[Set[str]] = write_fasta(
+        [(outputs.fasta, outputs.sequence_stats, strains)
+         for outputs, strains in zip(query_outputs, metadata_filtered_sequences)],
         gisaid_fasta,
         max_ambig,
         max_length,
-        metadata_filtered_sequences,
         min_length,
-        user_fasta
+        user_fasta,
+        cache_dir=cache_dir,
+        threads=threads
     )
-    logging.info(f'Wrote {len(keep_samples)} sequences to "{fasta_output}"')
-    logging.info(f'Writing filtered metadata table with {keep_samples} entries to "{filtered_metadata}"')
-    df_filtered = write_filtered_metadata(df_subset, filtered_metadata, keep_samples)
-    logging.info(f'Writing Nextstrain metadata table to "{nextstrain_metadata}"')
-    write_nextstrain_metadata(df_filtered, nextstrain_metadata)
-    if statistics_output:
-        lineage_counts = get_lineage_counts(gisaid_lineages, mask)
-        stats = write_stats(
-            output_path=statistics_output,
-            gisaid_matching_lineage_counts=lineage_counts,
-            n_total_gisaid_sequences=df_gisaid.shape[0],
-            n_total_gisaid_lineages=gisaid_lineages.unique().size,
-            n_gisaid_matching_lineage=n_gisaid_matching_lineage,
-            n_metadata_filtered_sequences=df_subset.shape[0],
-            n_final_filtered_sequences=df_filtered.shape[0],
-            sample_lineages=sample_lineages
-        )
-        logging.info(f'Wrote GISAID filtering stats to "{statistics_output}"')
-        logging.info(f'Filtering stats: {stats}')
+    close_tar_streams()
+    query_metadata_stats = [metadata_stats for _, metadata_stats in query_results]
+    for query, outputs, keep_samples, df_subset, query_lineage_counts, metadata_stats in zip(
+            queries, query_outputs, query_keep_samples, df_subsets, lineage_counts, query_metadata_stats):
+        logging.info(f'Wrote {len(keep_samples)} sequences to "{outputs.fasta}"')
+        if outputs.sequence_stats:
+            logging.info(f'Wrote GISAID sequence QC stats to "{outputs.sequence_stats}"')
+        logging.info(f'Writing filtered metadata table with {keep_samples} entries to "{outputs.filtered_metadata}"')
+        df_filtered = write_filtered_metadata(df_subset, outputs.filtered_metadata, keep_samples)
+        logging.info(f'Writing Nextstrain metadata table to "{outputs.nextstrain_metadata}"')
+        write_nextstrain_metadata(df_filtered, outputs.nextstrain_metadata)
+        if outputs.statistics:
+            stats = write_stats(
+                output_path=outputs.statistics,
+                gisaid_matching_lineage_counts=query_lineage_counts,
+                **metadata_stats,
+                n_metadata_filtered_sequences=df_subset.shape[0],
+                n_final_filtered_sequences=df_filtered.shape[0],
+                sample_lineages=query.lineages
+            )
+            logging.info(f'Wrote GISAID filtering stats to "{outputs.statistics}"')
+            logging.info(f'Filtering stats{query_label(query)}: {stats}')
     logging.info('Done!')
 
 
-def get_lineage_counts(gisaid_lineages: pd.Series, mask: pd.Series) -> Dict[str, int]:
-    return gisaid_lineages[mask].value_counts().to_dict()
+class MetadataQuery(NamedTuple):
+    """GISAID metadata filters for one set of filtered GISAID outputs"""
+    name: str
+    lineages: Set[str]
+    dt_start: Optional[pd.Timestamp]
+    dt_end: Optional[pd.Timestamp]
+    country: Optional[str]
+    region: Optional[str]
+    max_gisaid_seqs: int
+
+
+class QueryOutputs(NamedTuple):
+    fasta: Path
+    filtered_metadata: Path
+    nextstrain_metadata: Path
+    statistics: Optional[Path]
+    sequence_stats: Optional[Path]
+
+
+def query_label(query: MetadataQuery) -> str:
+    return f' for query "{query.name}"' if query.name else ''
+
+
+def read_batch_queries(
+        path: Path,
+        default_query: MetadataQuery,
+        pangolin_lineages: Optional[str] = None
+) -> List[MetadataQuery]:
+    """Read GISAID metadata queries from a CSV or tab-delimited table with one query per row
+
+    The "name" column is required and is used as the output directory name for each query. Optional columns are
+    `BATCH_QUERY_COLUMNS`. Blank values are taken from the corresponding command-line option. The Pangolin lineages
+    of user sequences are always included in the lineages of each query.
+    """
+    if path.suffix.lower() == '.csv':
+        df = pd.read_csv(path, dtype=str)
+    else:
+        df = pd.read_table(path, dtype=str)
+    df.columns = df.columns.str.strip()
+    if 'name' not in df.columns:
+        raise ValueError(f'Batch queries table "{path}" must have a "name" column. Found columns: {list(df.columns)}')
+    unknown_columns = set(df.columns) - set(BATCH_QUERY_COLUMNS) - {'name'}
+    if unknown_columns:
+        logging.warning(f'Ignoring unknown columns in batch queries table "{path}": {unknown_columns}')
+    df = df.reindex(columns=['name'] + BATCH_QUERY_COLUMNS)
+    names = df['name'].fillna('').str.strip()
+    invalid_names = names[(names == '') | names.str.contains('/') | names.isin(['.', '..'])]
+    if not invalid_names.empty:
+        raise ValueError(f'Batch query names must be non-empty and valid directory names: {list(invalid_names)}')
+    if names.duplicated().any():
+        raise ValueError(f'Batch query names must be unique: {list(names[names.duplicated()])}')
+    queries = []
+    for name, row in zip(names, df.itertuples(index=False)):
+        lineages = row.pangolin_lineages if pd.notna(row.pangolin_lineages) else pangolin_lineages
+        query_lineages = {x.strip() for x in lineages.split(',') if x.strip() != ''} if lineages else set()
+        queries.append(MetadataQuery(
+            name=name,
+            lineages=default_query.lineages | query_lineages,
+            dt_start=parse_date_option(row.date_start) if pd.notna(row.date_start) else default_query.dt_start,
+            dt_end=parse_date_option(row.date_end) if pd.notna(row.date_end) else default_query.dt_end,
+            country=row.country if pd.notna(row.country) else default_query.country,
+            region=row.region if pd.notna(row.region) else default_query.region,
+            max_gisaid_seqs=(int(row.max_gisaid_seqs) if pd.notna(row.max_gisaid_seqs)
+                             else default_query.max_gisaid_seqs),
+        ))
+    return queries
+
+
+def get_lineage_counts(df_subset: pd.DataFrame) -> Dict[str, int]:
+    return {str(k): int(v) for k, v in df_subset['Pango_lineage'].value_counts().items() if v > 0}
+
+
+def parse_date_option(date: Optional[str]) -> Optional[pd.Timestamp]:
+    if not date:
+        return None
+    dt: pd.Timestamp = pd.to_datetime(date, errors='coerce')
+    if pd.isna(dt):
+        logging.info(f'Could not parse datetime from "{date}". No date filtering applied.')
+        return None
+    return dt
+
+
+def metadata_filter_mask(
+        df_filter: pd.DataFrame,
+        lineages: Set[str],
+        dt_start: Optional[pd.Timestamp] = None,
+        dt_end: Optional[pd.Timestamp] = None,
+        country: Optional[str] = None,
+        region: Optional[str] = None
+) -> Tuple[pd.Series, pd.Series]:
+    """Get GISAID metadata rows matching Pangolin lineages and other metadata filters
+
+    Comma-delimited `country` or `region` values are matched exactly, otherwise substring matching is used.
+    Filters are only evaluated against the categories of categorical columns and rows are matched by category
+    code, so each filter costs an integer lookup per row rather than a string comparison.
+
+    Arguments:
+        df_filter: Filter columns prepared by `metadata_filter_columns`
+        lineages: Pangolin lineages to match
+
+    Returns:
+        Tuple of the Pangolin lineage mask and the mask with all filters applied
+    """
+    lineage_codes = df_filter['Pango_lineage']
+    lineage_mask = lookup_categories(lineage_codes, lineage_codes.cat.categories.isin(list(lineages)))
+    mask = lineage_mask
+    if dt_start is not None or dt_end is not None:
+        collection_datetimes = df_filter['Collection_date'].values
+        if dt_start is not None:
+            mask = mask & (collection_datetimes >= np.datetime64(dt_start))
+        if dt_end is not None:
+            mask = mask & (collection_datetimes <= np.datetime64(dt_end))
+    for column, value in (('country', country), ('region', region)):
+        if not value:
+            continue
+        categories = df_filter[column].cat.categories
+        if ',' in value:
+            values = [x.strip() for x in value.split(',') if x.strip() != '']
+            matched = categories.isin(values)
+        else:
+            matched = categories.astype(str).str.contains(value)
+        mask = mask & lookup_categories(df_filter[column], np.asarray(matched, dtype=bool))
+    return pd.Series(lineage_mask, index=df_filter.index), pd.Series(mask, index=df_filter.index)
+
+
+def metadata_filter_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Parse the GISAID metadata columns used for filtering once
+
+    Pangolin lineage, region and country are converted to categoricals and collection dates to datetimes so that
+    the same parsed columns can be reused for any number of filters. Region and country are split from "Location"
+    if not already present.
+    """
+    columns = {
+        'Pango_lineage': df['Pango_lineage'].astype('category'),
+        'Collection_date': parse_collection_dates(df['Collection_date']),
+    }
+    if 'region' in df.columns and 'country' in df.columns:
+        for column in ('region', 'country'):
+            columns[column] = df[column].astype('category')
+    else:
+        df_locations = split_locations(df['Location'], ['region', 'country'])
+        for column in ('region', 'country'):
+            columns[column] = df_locations[column]
+    return pd.DataFrame(columns, index=df.index)
+
+
+def lookup_categories(values: pd.Series, category_values: np.ndarray) -> np.ndarray:
+    """Look up a value computed for each category of a categorical for each row by category code
+
+    Missing values (code -1) get the value appended to the end of `category_values` (False or NaT).
+    """
+    fill = np.array([np.datetime64('NaT')]) if category_values.dtype.kind == 'M' else np.zeros(1, dtype=bool)
+    return np.concatenate([category_values, fill.astype(category_values.dtype)])[values.cat.codes.values]
+
+
+def parse_collection_dates(dates: pd.Series) -> pd.Series:
+    """Parse GISAID collection dates to datetimes, parsing each unique date once
+
+    Dates are parsed as "%Y-%m-%d" with fallbacks for partial dates like "2021-05" and "2021", which are parsed
+    as the start of the month or year. Dates that cannot be parsed are NaT.
+    """
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates
+    dates = dates.astype('category')
+    categories = dates.cat.categories.astype(str)
+    parsed = np.full(categories.size, np.datetime64('NaT'), dtype='datetime64[ns]')
+    unparsed = np.ones(categories.size, dtype=bool)
+    for date_format in COLLECTION_DATE_FORMATS:
+        if not unparsed.any():
+            break
+        idx = np.flatnonzero(unparsed)
+        datetimes = pd.to_datetime(categories[idx], format=date_format, errors='coerce')
+        is_parsed = ~datetimes.isna()
+        parsed[idx[is_parsed]] = datetimes[is_parsed].values
+        unparsed[idx[is_parsed]] = False
+    return pd.Series(lookup_categories(dates, parsed), index=dates.index)
+
+
+def split_locations(locations: pd.Series, columns: List[str] = LOCATION_COLUMNS) -> pd.DataFrame:
+    """Split GISAID "Location" values into region, country, division and city categoricals
+
+    Each unique location is only split once and rows are mapped to their location parts by category code.
+    """
+    locations = locations.astype('category')
+    df_parts = locations.cat.categories.to_series().str.split(r'\s*/\s*', n=3, expand=True)
+    df_parts = df_parts.reindex(columns=range(len(columns)))
+    codes = locations.cat.codes.values
+    df_locations = pd.DataFrame(index=locations.index)
+    for i, column in enumerate(columns):
+        part_codes, part_categories = pd.factorize(df_parts[i])
+        df_locations[column] = pd.Categorical.from_codes(np.append(part_codes, -1)[codes],
+                                                         categories=part_categories.astype(object))
+    return df_locations
 
 
-def parse_fasta(gisaid_sequences: Path):
-    with open(gisaid_sequences) as fin:
-        yield SimpleFastaParser(fin)
+def read_gisaid_fasta(gisaid_sequences: Path, threads: int = 1) -> Iterator[Tuple[str, bytes]]:
+    """Read GISAID sequences FASTA, which may be compressed and/or within a TAR file, block by block"""
+    with open_gisaid_file(gisaid_sequences, r'.*\.fasta$', threads=threads) as fh:
+        for block in iter_fasta_blocks(fh):
+            yield from parse_fasta_block(block)
 
 
 def write_filtered_metadata(
@@ -189,17 +470,138 @@ def write_stats(
     return stats
 
 
-def write_fasta(fasta_output, gisaid_sequences, max_ambig, max_length, metadata_filtered_sequences, min_length,
-                sequences):
-    with open(fasta_output, 'w') as fout:
-        n_user_sequences = write_user_sequences(fout, sequences)
-        logging.info(f'Wrote {n_user_sequences} user sequences to "{fasta_output}"')
-        is_tarred = tarfile.is_tarfile(gisaid_sequences)
-        logging.info(f'GISAID sequences from "{gisaid_sequences}" provided as {"TAR" if is_tarred else "FASTA"} file')
-        iterator = read_fasta_tarxz(gisaid_sequences) if is_tarred else parse_fasta(gisaid_sequences)
-        keep_samples = write_filtered_gisaid_seqs(fout, iterator, metadata_filtered_sequences, min_length, max_length,
-                                                  max_ambig)
-    return keep_samples
+def write_fasta(
+        fasta_outputs: List[Tuple[Path, Optional[Path], Set[str]]],
+        gisaid_sequences: Path,
+        max_ambig: int,
+        max_length: int,
+        min_length: int,
+        sequences: Path,
+        cache_dir: Optional[Path] = None,
+        threads: int = 1
+) -> List[Set[str]]:
+    """Write user sequences and GISAID sequences passing filters to each output FASTA
+
+    GISAID sequences are read and checked once for the union of the sequence IDs of all outputs and each checked
+    sequence is written to every output that selected it.
+
+    Arguments:
+        fasta_outputs: Output FASTA path, optional per-sequence QC stats output path and GISAID sequence IDs to
+            output for each output
+        gisaid_sequences: GISAID sequences FASTA, which may be compressed and/or within a TAR file
+        max_ambig: Max number of ambiguous bases in sequences
+        max_length: Maximum length of sequences
+        min_length: Minimum length of sequences
+        sequences: User sequences FASTA
+        cache_dir: Optional directory with cached GISAID sequences FASTA index
+        threads: Number of worker processes for checking GISAID sequences
+
+    Returns:
+        GISAID sequence names that were written to each output
+    """
+    with ExitStack() as stack:
+        outputs = []
+        for fasta_output, stats_output, seq_ids in fasta_outputs:
+            fout = stack.enter_context(open(fasta_output, 'w'))
+            fstats = stack.enter_context(open(stats_output, 'w')) if stats_output else None
+            n_user_sequences = write_user_sequences(fout, sequences)
+            logging.info(f'Wrote {n_user_sequences} user sequences to "{fasta_output}"')
+            outputs.append((fout, fstats, seq_ids))
+        all_seq_ids = set().union(*(seq_ids for _, _, seq_ids in fasta_outputs))
+        compression, is_tarred = detect_file_type(gisaid_sequences)
+        logging.info(f'GISAID sequences from "{gisaid_sequences}" provided as '
+                     f'{"TAR" if is_tarred else "FASTA"} file with compression: {compression}')
+        is_plain = compression is None and not is_tarred
+        if cache_dir and is_plain:
+            df_index = get_fasta_index(gisaid_sequences, cache_dir)
+            checked_seqs = check_gisaid_seqs(read_indexed_fasta(gisaid_sequences, df_index, all_seq_ids),
+                                             all_seq_ids, min_length, max_length, max_ambig)
+        elif threads > 1:
+            checked_seqs = check_gisaid_seqs_parallel(gisaid_sequences, is_plain, all_seq_ids,
+                                                      min_length, max_length, max_ambig, threads=threads)
+        else:
+            checked_seqs = check_gisaid_seqs(read_gisaid_fasta(gisaid_sequences), all_seq_ids,
+                                             min_length, max_length, max_ambig)
+        if len(outputs) == 1:
+            fout, fstats, _ = outputs[0]
+            return [write_checked_gisaid_seqs(fout, checked_seqs, stats_handle=fstats)]
+        return write_checked_gisaid_seqs_to_outputs(outputs, checked_seqs)
+
+
+def normalize_strain_name(header: str) -> str:
+    """Get GISAID strain name from FASTA header as it appears in the normalized metadata table"""
+    if '|' in header:
+        header = header.split('|')[0]
+    if ' ' in header:
+        header = header.replace(' ', '_')
+    return header
+
+
+def get_fasta_index(fasta: Path, cache_dir: Path) -> pd.DataFrame:
+    """Get cached strain name index for GISAID sequences FASTA, building it if necessary"""
+    index_path = cache_dir / f'gisaid_sequences.{file_cache_key(fasta)}.idx'
+    if index_path.exists():
+        logging.info(f'Reading GISAID sequences FASTA index "{index_path}" for "{fasta}"')
+        return read_fasta_index(index_path)
+    logging.info(f'Building strain name index for GISAID sequences FASTA "{fasta}"')
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = index_path.with_name(f'.{index_path.name}.{os.getpid()}.tmp')
+    n_records = write_fasta_index(fasta, tmp_path)
+    tmp_path.replace(index_path)
+    logging.info(f'Wrote GISAID sequences FASTA index with {n_records} records to "{index_path}"')
+    return read_fasta_index(index_path)
+
+
+def write_fasta_index(fasta: Path, index_path: Path) -> int:
+    """Write tab-delimited index of normalized strain name, record byte offset and record byte length
+
+    Unlike a samtools faidx index, duplicate names are allowed and all records are indexed in file order.
+    """
+    import mmap
+    n_records = 0
+    with open(fasta, 'rb') as fh, open(index_path, 'w') as fout:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return n_records
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0 if mm[:1] == b'>' else mm.find(b'\n>')
+            if start == -1:
+                return n_records
+            if start > 0:
+                start += 1
+            while start != -1:
+                header_end = mm.find(b'\n', start)
+                if header_end == -1:
+                    header_end = mm.size()
+                end = mm.find(b'\n>', header_end)
+                end = mm.size() if end == -1 else end + 1
+                header = mm[start + 1:header_end].decode().rstrip()
+                fout.write(f'{normalize_strain_name(header)}\t{start}\t{end - start}\n')
+                n_records += 1
+                start = end if end < mm.size() else -1
+    return n_records
+
+
+def read_fasta_index(index_path: Path) -> pd.DataFrame:
+    return pd.read_table(index_path,
+                         header=None,
+                         names=['name', 'offset', 'length'],
+                         dtype={'name': str, 'offset': 'int64', 'length': 'int64'},
+                         keep_default_na=False)
+
+
+def read_indexed_fasta(fasta: Path, df_index: pd.DataFrame, names: Set[str]) -> Iterator[Tuple[str, bytes]]:
+    """Read only the records for the specified strain names from a FASTA file using its strain name index
+
+    Records are yielded in file order so that duplicate strain names are handled as with a full scan.
+    """
+    df_selected = df_index[df_index['name'].isin(names)].sort_values('offset')
+    logging.info(f'Reading {df_selected.shape[0]} of {df_index.shape[0]} indexed GISAID sequences from "{fasta}"')
+    with open(fasta, 'rb') as fh:
+        for offset, length in zip(df_selected['offset'], df_selected['length']):
+            fh.seek(offset)
+            header, _, seq = fh.read(length).partition(b'\n')
+            lines = (x.rstrip() for x in seq.split(b'\n'))
+            yield header[1:].decode().rstrip(), b''.join(lines).replace(b' ', b'').replace(b'\r', b'')
 
 
 def init_logging():
@@ -217,41 +619,18 @@ def init_logging():
     )
 
 
-def sampling_gisaid(df: pd.DataFrame, max_gisaid_seqs: int) -> Set[str]:
-    df_lineages_count = df['Pango_lineage'].value_counts(ascending=True).to_frame('count')
-    n_lineages = df_lineages_count.shape[0]
-    sampled_gisaid = set()
-    seqs_per_lineages = int((max_gisaid_seqs - len(sampled_gisaid)) / n_lineages)
-    for i, (lineage, row) in enumerate(df_lineages_count.iterrows()):
-        seqs_in_lineages = df[df['Pango_lineage'] == lineage]
-        if row['count'] < seqs_per_lineages:
-            logging.info(
-                f'No need to sample lineage "{lineage}" (sequences '
-                f'count={row["count"]}; less than {seqs_per_lineages} seqs '
-                f'per lineage)')
-            sampled_gisaid |= set(seqs_in_lineages.index)
-        else:
-            try:
-                weights = 1.0 - seqs_in_lineages['N_Content'].values
-                weights[np.isnan(weights)] = 0.0
-                weights = np.clip(weights, 0.0, 1.0)
-                logging.info(
-                    f'Using GISAID provided N content for down-sampling '
-                    f'weights for {lineage}, (sequences count={row["count"]}; '
-                    f'greater than {seqs_per_lineages} seqs per lineage)'
-                    f'. Mean N content: {seqs_in_lineages["N_Content"].mean()}')
-                sampled_gisaid |= set(seqs_in_lineages.index.to_series().sample(n=seqs_per_lineages, weights=weights))
-            except ValueError as ex:
-                logging.warning(
-                    f'Could not use weights based on "N_Content" GISAID '
-                    f'metadata field, using equal probability weights for '
-                    f'down-sampling {lineage} (sequences count={row["count"]};'
-                    f' greater than {seqs_per_lineages} seqs per lineage). '
-                    f'Error: "{ex}"')
-                sampled_gisaid |= set(seqs_in_lineages.index.to_series().sample(n=seqs_per_lineages))
-        if n_lineages < i + 1:
-            seqs_per_lineages = (max_gisaid_seqs - len(sampled_gisaid)) / (n_lineages - i + 1)
-    return sampled_gisaid
+def sampling_gisaid(df: pd.DataFrame, max_gisaid_seqs: int, seed: Optional[int] = None) -> Set[str]:
+    """Down-sample GISAID sequences stratified by Pangolin lineage, favouring sequences with less N content"""
+    if 'N_Content' in df.columns:
+        weights = n_content_weights(df['N_Content'])
+        logging.info(f'Using GISAID provided N content for down-sampling weights. '
+                     f'Mean N content: {df["N_Content"].mean()}')
+    else:
+        weights = None
+        logging.warning('No "N_Content" GISAID metadata field, using equal probability weights for down-sampling.')
+    sampled = stratified_sample(df, 'Pango_lineage', max_gisaid_seqs, weights=weights,
+                                rng=np.random.default_rng(seed))
+    return set(sampled)
 
 
 def write_user_sequences(fout: IO[str], sequences: Path) -> int:
@@ -294,11 +673,12 @@ def write_nextstrain_metadata(df_filtered: pd.DataFrame, nextstrain_metadata: Pa
 
 def write_filtered_gisaid_seqs(
         handle: IO[str],
-        header_seqs: Iterator[Tuple[str, str]],
+        header_seqs: Iterator[Tuple[str, bytes]],
         seq_ids: Set[str],
         min_length: int = 28000,
         max_length: int = 31000,
-        n_ambiguous: int = 3000
+        n_ambiguous: int = 3000,
+        stats_handle: Optional[IO[str]] = None
 ) -> Set[str]:
     """Write GISAID sequences passing filters to FASTA file
     
@@ -310,86 +690,513 @@ def write_filtered_gisaid_seqs(
     
     Arguments:
         handle: Output file handle
-        header_seqs: Iterator yielding tuple of header and sequence
+        header_seqs: Iterator yielding tuple of header and sequence bytes
         seq_ids: GISAID sequence IDs to output
         min_length: Minimum length of sequences
         max_length: Maximum length of sequences
         n_ambiguous: Max number of ambiguous bases in sequences
+        stats_handle: Optional output file handle for per-sequence QC stats of sequences matching `seq_ids`
 
     Returns:
         Set of GISAID sequence names that were output
     """
-    keep_samples = set()
+    checked_seqs = check_gisaid_seqs(header_seqs, seq_ids, min_length, max_length, n_ambiguous)
+    return write_checked_gisaid_seqs(handle, checked_seqs, stats_handle=stats_handle)
+
+
+def check_gisaid_seqs(
+        header_seqs: Iterator[Tuple[str, bytes]],
+        seq_ids: Set[str],
+        min_length: int = 28000,
+        max_length: int = 31000,
+        n_ambiguous: int = 3000
+) -> Iterator[CheckedSeq]:
+    """Get QC stats and pass/fail status of GISAID sequences with IDs in `seq_ids`
+
+    Every sequence with an ID in `seq_ids` is yielded with its normalized strain name, QC stats and whether it passed
+    filters. The sequence is only included if it passed filters and is None otherwise, so callers writing QC stats
+    must not skip failed sequences.
+    """
     for strains, seq in header_seqs:
-        if '|' in strains:
-            strains = strains.split('|')[0]
-        if ' ' in strains:
-            strains = strains.replace(' ', '_')
+        strains = normalize_strain_name(strains)
         if strains not in seq_ids:
             continue
-        if (
-                min_length < len(seq) <= max_length
-                and count_ambig_nt(seq) < n_ambiguous
-                and strains not in keep_samples
-        ):
+        stats = sequence_stats(seq)
+        length, n_ambig, _, _ = stats
+        passed = min_length < length <= max_length and n_ambig < n_ambiguous
+        yield strains, stats, passed, (seq if passed else None)
+
+
+def write_checked_gisaid_seqs(
+        handle: IO[str],
+        checked_seqs: Iterator[CheckedSeq],
+        stats_handle: Optional[IO[str]] = None
+) -> Set[str]:
+    """Write first occurrence of each GISAID sequence passing filters and optionally QC stats"""
+    keep_samples = set()
+    if stats_handle:
+        stats_handle.write('\t'.join(SEQUENCE_STATS_COLUMNS) + '\n')
+    for strains, (length, n_ambig, n_n, n_gap), passed, seq in checked_seqs:
+        if strains in keep_samples:
+            continue
+        if stats_handle:
+            stats_handle.write(f'{strains}\t{length}\t{n_ambig}\t{n_n}\t{n_gap}\t{passed}\n')
+        if passed:
             keep_samples.add(strains)
-            handle.write(f'>{strains}\n{seq}\n')
+            handle.write(f'>{strains}\n{seq.decode()}\n')
     return keep_samples
 
 
-def read_gisaid_metadata(gisaid_metadata: Path) -> pd.DataFrame:
-    if tarfile.is_tarfile(gisaid_metadata):
-        with tarfile.open(gisaid_metadata, "r:*") as tar:
-            df = pd.read_table(get_file_from_tar(tar, r'.*\.tsv'), index_col=0)
-    else:
-        df = pd.read_table(gisaid_metadata, index_col=0)
+def write_checked_gisaid_seqs_to_outputs(
+        outputs: List[Tuple[IO[str], Optional[IO[str]], Set[str]]],
+        checked_seqs: Iterator[CheckedSeq]
+) -> List[Set[str]]:
+    """Write each checked GISAID sequence to every output with its ID like `write_checked_gisaid_seqs`
+
+    Arguments:
+        outputs: Output FASTA handle, optional QC stats output handle and GISAID sequence IDs for each output
+        checked_seqs: Checked GISAID sequences for the union of sequence IDs of all outputs
+
+    Returns:
+        Set of GISAID sequence names that were output for each output
+    """
+    keep_samples = [set() for _ in outputs]
+    output_indices: Dict[str, List[int]] = {}
+    for i, (_, stats_handle, seq_ids) in enumerate(outputs):
+        if stats_handle:
+            stats_handle.write('\t'.join(SEQUENCE_STATS_COLUMNS) + '\n')
+        for seq_id in seq_ids:
+            output_indices.setdefault(seq_id, []).append(i)
+    for strains, (length, n_ambig, n_n, n_gap), passed, seq in checked_seqs:
+        stats_line = f'{strains}\t{length}\t{n_ambig}\t{n_n}\t{n_gap}\t{passed}\n'
+        record = f'>{strains}\n{seq.decode()}\n' if passed else None
+        for i in output_indices.get(strains, []):
+            if strains in keep_samples[i]:
+                continue
+            handle, stats_handle, _ = outputs[i]
+            if stats_handle:
+                stats_handle.write(stats_line)
+            if passed:
+                keep_samples[i].add(strains)
+                handle.write(record)
+    return keep_samples
+
+
+def check_gisaid_seqs_parallel(
+        gisaid_sequences: Path,
+        is_plain: bool,
+        seq_ids: Set[str],
+        min_length: int = 28000,
+        max_length: int = 31000,
+        n_ambiguous: int = 3000,
+        threads: int = 2,
+        block_size: int = FASTA_BLOCK_SIZE
+) -> Iterator[CheckedSeq]:
+    """Check GISAID sequences in record-aligned blocks using a pool of worker processes
+
+    Plain FASTA files are split into byte ranges that `threads` workers read themselves. For compressed and/or TAR
+    files, a single threaded decompressor feeds blocks of the FASTA to `threads` - 1 workers, so that the
+    decompressor and workers use at most `threads` CPUs. Results are yielded in file order.
+    """
+    from multiprocessing import Pool
+    n_workers = threads if is_plain else max(threads - 1, 1)
+    logging.info(f'Checking GISAID sequences using {n_workers} worker processes')
+    with Pool(n_workers,
+              initializer=init_check_worker,
+              initargs=(seq_ids, min_length, max_length, n_ambiguous)) as pool:
+        if is_plain:
+            ranges = ((gisaid_sequences, start, end) for start, end in fasta_block_ranges(gisaid_sequences,
+                                                                                            block_size))
+            for checked_seqs in imap_ordered(pool, check_fasta_range, ranges, max_pending=2 * n_workers):
+                yield from checked_seqs
+        else:
+            with open_gisaid_file(gisaid_sequences, r'.*\.fasta$', threads=1) as fh:
+                blocks = iter_fasta_blocks(fh, block_size)
+                for checked_seqs in imap_ordered(pool, check_fasta_block, blocks, max_pending=2 * n_workers):
+                    yield from checked_seqs
+
+
+# GISAID sequence filters set in each worker process by `init_check_worker`
+check_worker_args: Tuple = ()
+
+
+def init_check_worker(seq_ids: Set[str], min_length: int, max_length: int, n_ambiguous: int) -> None:
+    global check_worker_args
+    check_worker_args = (seq_ids, min_length, max_length, n_ambiguous)
+
+
+def check_fasta_block(block: bytes) -> List[CheckedSeq]:
+    return list(check_gisaid_seqs(parse_fasta_block(block), *check_worker_args))
+
+
+def check_fasta_range(task: Tuple[Path, int, int]) -> List[CheckedSeq]:
+    fasta, start, end = task
+    with open(fasta, 'rb') as fh:
+        fh.seek(start)
+        return check_fasta_block(fh.read(end - start))
+
+
+def fasta_block_ranges(fasta: Path, block_size: int = FASTA_BLOCK_SIZE) -> Iterator[Tuple[int, int]]:
+    """Split FASTA file into byte ranges of about `block_size` bytes starting at record boundaries"""
+    import mmap
+    with open(fasta, 'rb') as fh:
+        size = os.fstat(fh.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            while start < size:
+                end = mm.find(b'\n>', start + block_size)
+                end = size if end == -1 else end + 1
+                yield start, end
+                start = end
+
+
+def read_gisaid_metadata(gisaid_metadata: Path, cache_dir: Optional[Path] = None) -> pd.DataFrame:
+    """Read and normalize GISAID metadata table, using a cached copy if available
+
+    Arguments:
+        gisaid_metadata: GISAID metadata TSV or TAR file containing the metadata TSV
+        cache_dir: Optional directory to read/write cached normalized metadata tables from/to
+
+    Returns:
+        Normalized GISAID metadata table indexed by strain name
+    """
+    if cache_dir is None:
+        return parse_gisaid_metadata(gisaid_metadata)
+    cache_path = find_metadata_cache(gisaid_metadata, cache_dir)
+    if cache_path is not None:
+        logging.info(f'Reading cached GISAID metadata table "{cache_path}" for "{gisaid_metadata}"')
+        return read_metadata_cache(cache_path)
+    df = parse_gisaid_metadata(gisaid_metadata)
+    cache_path = write_metadata_cache(df, metadata_cache_path(gisaid_metadata, cache_dir))
+    logging.info(f'Cached normalized GISAID metadata table to "{cache_path}"')
+    return df
+
+
+def parse_gisaid_metadata(gisaid_metadata: Path) -> pd.DataFrame:
+    with open_gisaid_metadata(gisaid_metadata) as fh:
+        df = pd.read_table(fh, index_col=0)
     logging.info(f'Columns in GISAID metadata file: {df.columns}')
+    return normalize_gisaid_metadata(df)
+
+
+def open_gisaid_metadata(gisaid_metadata: Path) -> ContextManager[IO[bytes]]:
+    """Open GISAID metadata TSV directly or from within a TAR file"""
+    return open_gisaid_file(gisaid_metadata, r'.*\.tsv')
+
+
+def normalize_column_names(columns: pd.Index) -> pd.Index:
     # Replace non-word characters in column names with '_'
-    df.columns = df.columns.str.replace(r'[^\w]+', '_', regex=True).str.replace(r'_+$', '', regex=True)
+    return columns.str.replace(r'[^\w]+', '_', regex=True).str.replace(r'_+$', '', regex=True)
+
+
+def normalize_gisaid_metadata(df: pd.DataFrame) -> pd.DataFrame:
+    df.columns = normalize_column_names(df.columns)
     # Strip whitespace from strain name
     df.index = df.index.str.replace(r'\s+', '_', regex=True)
     # Extract details of location into separate column
-    df_locations = df['Location'].str.split(r'\s*/\s*', n=3, expand=True)
-    df_locations.columns = ['region', 'country', 'division', 'city']
+    df_locations = split_locations(df['Location'])
     return pd.concat([df, df_locations], axis=1)
 
 
-def count_ambig_nt(seq: str) -> int:
-    return sum(1 for x in seq.lower() if x not in {'a', 'g', 'c', 't', '-'})
-
-
-def read_fasta_tarxz(tarxz_path) -> Iterator[Tuple[str, str]]:
-    """Read first fasta file in a tar file"""
-    # Skip any text before the first record (e.g. blank lines, comments)
-    with tarfile.open(tarxz_path) as tar:
-        handle = get_file_from_tar(tar, r'.*\.fasta$')
-        for line in handle:
-            line = line.decode()
-            if line[0] == ">":
-                title = line[1:].rstrip()
-                break
-            else:
-                # no break encountered - probably an empty file
-                return
-        lines = []
-        for line in handle:
-            line = line.decode()
-            if line[0] == ">":
-                yield title, "".join(lines).replace(" ", "").replace("\r", "")
-                lines = []
-                title = line[1:].rstrip()
-                continue
-            lines.append(line.rstrip())
-        yield title, "".join(lines).replace(" ", "").replace("\r", "")
+def iter_gisaid_metadata_filter_columns(
+        gisaid_metadata: Path,
+        chunksize: int = 500000,
+        cache_dir: Optional[Path] = None
+) -> Iterator[pd.DataFrame]:
+    """Yield chunks of normalized GISAID metadata with only the columns required for filtering
 
+    Pangolin lineage, location and collection date are read as categoricals and N content as float.
+    """
+    cache_path = find_metadata_cache(gisaid_metadata, cache_dir) if cache_dir else None
+    if cache_path is not None and cache_path.suffix == '.parquet':
+        import pyarrow.parquet as pq
+        logging.info(f'Reading GISAID metadata filter columns from cache "{cache_path}"')
+        cached_columns = set(pq.read_schema(cache_path).names)
+        columns = [x for x in FILTER_COLUMNS + ['region', 'country'] if x in cached_columns]
+        df = read_metadata_cache(cache_path, columns=columns)
+        chunks = (df.iloc[i:i + chunksize] for i in range(0, df.shape[0], chunksize))
+        yield from chunks
+        return
+    with open_gisaid_metadata(gisaid_metadata) as fh:
+        # read header from the same stream so that the metadata is only decompressed once
+        header_line = fh.readline()
+        fh = io.BufferedReader(PrefixedStream(header_line, fh), buffer_size=FASTA_BLOCK_SIZE)
+        header = header_line.decode().rstrip('\r\n').split('\t')
+        normalized = dict(zip(normalize_column_names(pd.Index(header)), header))
+        columns = [x for x in FILTER_COLUMNS if x in normalized]
+        dtypes = {normalized['Pango_lineage']: 'category',
+                  normalized['Location']: 'category',
+                  normalized['Collection_date']: 'category'}
+        if 'N_Content' in normalized:
+            dtypes[normalized['N_Content']] = 'float32'
+        reader = pd.read_table(fh,
+                               index_col=0,
+                               usecols=[header[0]] + [normalized[x] for x in columns],
+                               dtype=dtypes,
+                               chunksize=chunksize)
+        for chunk in reader:
+            chunk.columns = normalize_column_names(chunk.columns)
+            chunk.index = chunk.index.str.replace(r'\s+', '_', regex=True)
+            yield chunk
 
-def get_file_from_tar(tar: tarfile.TarFile, name: str) -> Optional[IO[bytes]]:
-    while True:
-        file_member = tar.next()
-        if file_member is None:
-            break
-        if re.match(name, file_member.name):
-            return tar.extractfile(file_member)
+
+def scan_gisaid_metadata(
+        gisaid_metadata: Path,
+        queries: List[MetadataQuery],
+        chunksize: int = 500000,
+        cache_dir: Optional[Path] = None
+) -> List[Tuple[pd.DataFrame, Dict[str, int]]]:
+    """Filter GISAID metadata chunk by chunk only keeping filter columns for rows passing filters of each query
+
+    Returns:
+        Tuple of the filter columns of GISAID metadata rows passing filters and GISAID metadata stats for each query
+    """
+    n_total = 0
+    n_matching_lineage = [0 for _ in queries]
+    all_lineages = set()
+    has_na_lineage = False
+    query_dfs = [[] for _ in queries]
+    for chunk in iter_gisaid_metadata_filter_columns(gisaid_metadata, chunksize=chunksize, cache_dir=cache_dir):
+        df_filter = metadata_filter_columns(chunk)
+        chunk = chunk.assign(region=df_filter['region'].values, country=df_filter['country'].values)
+        n_total += chunk.shape[0]
+        gisaid_lineages = df_filter['Pango_lineage']
+        all_lineages |= set(gisaid_lineages.dropna().unique())
+        has_na_lineage |= bool(gisaid_lineages.isna().any())
+        for i, query in enumerate(queries):
+            lineage_mask, mask = metadata_filter_mask(df_filter, query.lineages, query.dt_start, query.dt_end,
+                                                      query.country, query.region)
+            n_matching_lineage[i] += int(lineage_mask.sum())
+            query_dfs[i].append(chunk.loc[mask.values, :])
+        logging.info(f'Scanned {n_total} GISAID metadata rows; '
+                     f'{sum(x.shape[0] for dfs in query_dfs for x in dfs)} passing filters')
+    results = []
+    for dfs, n_matching in zip(query_dfs, n_matching_lineage):
+        df = pd.concat(dfs) if dfs else pd.DataFrame(columns=FILTER_COLUMNS + ['region', 'country'])
+        df['Pango_lineage'] = df['Pango_lineage'].astype(str)
+        stats = dict(
+            n_total_gisaid_sequences=n_total,
+            n_total_gisaid_lineages=len(all_lineages) + int(has_na_lineage),
+            n_gisaid_matching_lineage=n_matching,
+        )
+        results.append((df, stats))
+    return results
+
+
+def read_gisaid_metadata_rows(
+        gisaid_metadata: Path,
+        strains: Set[str],
+        chunksize: int = 500000,
+        cache_dir: Optional[Path] = None
+) -> pd.DataFrame:
+    """Read all columns of GISAID metadata for the specified strains only
+
+    Only the first occurrence of each strain is returned.
+    """
+    cache_path = find_metadata_cache(gisaid_metadata, cache_dir) if cache_dir else None
+    if cache_path is not None and cache_path.suffix == '.parquet':
+        import pyarrow.parquet as pq
+        index_name = pq.read_schema(cache_path).pandas_metadata['index_columns'][0]
+        df = pd.read_parquet(cache_path, filters=[(index_name, 'in', list(strains))])
+    else:
+        dfs = []
+        with open_gisaid_metadata(gisaid_metadata) as fh:
+            for chunk in pd.read_table(fh, index_col=0, chunksize=chunksize):
+                chunk_strains = chunk.index.str.replace(r'\s+', '_', regex=True)
+                dfs.append(chunk.loc[chunk_strains.isin(strains), :])
+        df = normalize_gisaid_metadata(pd.concat(dfs))
+    return df[~df.index.duplicated()]
+
+
+def file_cache_key(path: Path, block_size: int = 1 << 20) -> str:
+    """Key for a GISAID file based on its size, mtime and a hash of its first and last blocks
+
+    Hashing the whole multi-GB file would cost about as much as parsing it, so only the first and last
+    `block_size` bytes are hashed along with the file size and modification time.
+    """
+    stat = path.stat()
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f'{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    with open(path, 'rb') as fh:
+        h.update(fh.read(block_size))
+        if stat.st_size > block_size:
+            fh.seek(max(block_size, stat.st_size - block_size))
+            h.update(fh.read(block_size))
+    return h.hexdigest()
+
+
+def metadata_cache_path(gisaid_metadata: Path, cache_dir: Path) -> Path:
+    key = file_cache_key(gisaid_metadata)
+    ext = 'parquet' if has_pyarrow() else 'pkl'
+    return cache_dir / f'gisaid_metadata.{key}.{ext}'
+
+
+def find_metadata_cache(gisaid_metadata: Path, cache_dir: Path) -> Optional[Path]:
+    cache_path = metadata_cache_path(gisaid_metadata, cache_dir)
+    for path in (cache_path.with_suffix('.parquet'), cache_path.with_suffix('.pkl')):
+        if path.exists():
+            return path
+    return None
+
+
+def has_pyarrow() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def read_metadata_cache(cache_path: Path, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Read cached GISAID metadata, only loading the specified columns from Parquet files"""
+    if cache_path.suffix == '.parquet':
+        return pd.read_parquet(cache_path, columns=columns, memory_map=True)
+    df = pd.read_pickle(cache_path)
+    return df if columns is None else df[columns]
+
+
+def write_metadata_cache(df: pd.DataFrame, cache_path: Path) -> Path:
+    """Write GISAID metadata cache file atomically so concurrent runs never see a partial file
+
+    Falls back to a pickle file if the table cannot be converted to Parquet (e.g. mixed type columns).
+    """
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(f'.{cache_path.name}.{os.getpid()}.tmp')
+    if cache_path.suffix == '.parquet':
+        try:
+            df.to_parquet(tmp_path)
+            tmp_path.replace(cache_path)
+            return cache_path
+        except Exception as ex:
+            logging.warning(f'Could not write GISAID metadata cache as Parquet, writing pickle instead. Error: {ex}')
+            tmp_path.unlink(missing_ok=True)
+            cache_path = cache_path.with_suffix('.pkl')
+    df.to_pickle(tmp_path)
+    tmp_path.replace(cache_path)
+    return cache_path
+
+
+@contextmanager
+def open_gisaid_file(path: Path, name: str, threads: int = 1) -> Iterator[IO[bytes]]:
+    """Open possibly compressed GISAID file or the first member matching `name` if it is a TAR file
+
+    TAR files are kept open as `TarStream`s so that GISAID metadata and sequences in the same TAR bundle can be
+    read in a single pass over the archive.
+    """
+    key = path.resolve()
+    if key not in tar_streams:
+        stack = ExitStack()
+        fh = stack.enter_context(open_decompressed(path, threads=threads))
+        head, fh = peek_stream(fh, TAR_HEADER_SIZE)
+        if not is_tar_header(head):
+            with stack:
+                yield fh
+            return
+        tar_streams[key] = TarStream(path, fh, stack, threads=threads)
+    yield tar_streams[key].open_member(name)
+
+
+# TAR files opened by `open_gisaid_file` by resolved path
+tar_streams: Dict[Path, 'TarStream'] = {}
+
+
+class TarStream:
+    """Serve members of a TAR file, reading a compressed TAR file as a single stream
+
+    Uncompressed TAR files are read with random access using the member offsets recorded on first touch.
+    Compressed TAR files are decompressed once from the start, serving members in the order that they appear in
+    the archive. Only a member that the stream has already passed requires decompressing the archive again.
+    """
+
+    def __init__(self, path: Path, fh: IO[bytes], stack: ExitStack, threads: int = 1):
+        self.path = path
+        self.threads = threads
+        self.seekable = detect_compression(path) is None
+        self.seen: List[str] = []
+        if self.seekable:
+            stack.close()
+            self.stack = ExitStack()
+            self.tar = self.stack.enter_context(tarfile.open(path, 'r:'))
+        else:
+            self.stack = stack
+            self.fh = fh
+            self.tar = tarfile.open(fileobj=fh, mode='r|')
+        # only stop decompressors of TAR files left open on errors. See `close_tar_streams`
+        atexit.register(self.close)
+
+    def open_member(self, name: str) -> IO[bytes]:
+        if self.seekable:
+            member = next((x for x in self.tar.getmembers() if re.match(name, x.name)), None)
+            if member is None:
+                raise FileNotFoundError(f'No file matching "{name}" found in TAR file "{self.path}"')
+            return self.tar.extractfile(member)
+        member = self.next_member(name)
+        if member is None and any(re.match(name, x) for x in self.seen):
+            logging.warning(f'File matching "{name}" already read from TAR file "{self.path}". Decompressing '
+                            f'"{self.path}" again from the start.')
+            self.reopen()
+            member = self.next_member(name)
+        if member is None:
+            raise FileNotFoundError(f'No file matching "{name}" found in TAR file "{self.path}"')
+        # members of TAR streams raise errors on `seekable()`, which pandas calls
+        return io.BufferedReader(PrefixedStream(b'', self.tar.extractfile(member)), buffer_size=FASTA_BLOCK_SIZE)
+
+    def next_member(self, name: str) -> Optional[tarfile.TarInfo]:
+        while True:
+            member = self.tar.next()
+            if member is None:
+                return None
+            self.seen.append(member.name)
+            if re.match(name, member.name):
+                return member
+
+    def reopen(self) -> None:
+        self.stack.close()
+        self.stack = ExitStack()
+        self.fh = self.stack.enter_context(open_decompressed(self.path, threads=self.threads))
+        self.tar = tarfile.open(fileobj=self.fh, mode='r|')
+        self.seen = []
+
+    def close(self, drain: bool = False) -> None:
+        """Close the TAR file
+
+        If `drain`, a compressed TAR stream is first read to the end so that decompressor errors for truncated or
+        corrupt files are raised.
+        """
+        if drain and not self.seekable:
+            while self.fh.read(FASTA_BLOCK_SIZE):
+                pass
+        self.stack.close()
+
+
+def close_tar_streams() -> None:
+    """Close TAR files opened by `open_gisaid_file` once all required members have been read
+
+    Decompressor errors are raised here rather than in an `atexit` handler, where they would not change the exit
+    status.
+    """
+    while tar_streams:
+        _, tar_stream = tar_streams.popitem()
+        tar_stream.close(drain=True)
+
+
+def detect_file_type(path: Path) -> Tuple[Optional[str], bool]:
+    """Get compression format ("xz", "zstd", "gzip" or None) of a file and whether it is a (compressed) TAR file"""
+    compression = detect_compression(path)
+    if path.resolve() in tar_streams:
+        return compression, True
+    if compression is None:
+        with open(path, 'rb') as fh:
+            return None, is_tar_header(fh.read(TAR_HEADER_SIZE))
+    with open_decompressed(path) as fh:
+        return compression, is_tar_header(read_exactly(fh, TAR_HEADER_SIZE))
+
+
+def is_tar_header(head: bytes) -> bool:
+    # POSIX and GNU TAR headers have "ustar" magic at offset 257
+    return len(head) >= 262 and head[257:262] == b'ustar'
 
 
 if __name__ == '__main__':
@@ -1,15 +1,21 @@
 #!/usr/bin/env python3
+import hashlib
 import logging
 import sys
-from collections import defaultdict
 from pathlib import Path
-from typing import Dict, Set, Tuple, Mapping, Optional
+from typing import Set, Tuple, Optional, Iterator
 
+import numpy as np
 import pandas as pd
 import typer
-from Bio.SeqIO.FastaIO import SimpleFastaParser
 from rich.logging import RichHandler
 
+from lineage_sampling import stratified_sample
+from sequence_io import UPPER_TABLE, iter_fasta_blocks, parse_fasta_block, sequence_stats
+
+# Columns of table of identical sequences collapsed into a representative sequence
+GROUPS_COLUMNS = ['representative', 'member']
+
 
 def main(input_fasta: Path = typer.Option(..., help='FASTA with sequences to filter'),
          input_metadata: Path = typer.Option(..., help='Metadata for input sequences'),
@@ -18,7 +24,17 @@ def main(input_fasta: Path = typer.Option(..., help='FASTA with sequences to fil
          country: Optional[str] = typer.Option(None, help='Preferentially filter for samples from this country'),
          max_seqs: int = typer.Option(10000, help='Max number of sequences to filter down to'),
          output_fasta: Path = typer.Option(Path('filtered.fasta'), help='Output filtered sequences FASTA'),
-         output_metadata: Path = typer.Option(Path('metadata.filtered.tsv'), help='Output filtered metadata table')):
+         output_metadata: Path = typer.Option(Path('metadata.filtered.tsv'), help='Output filtered metadata table'),
+         seed: Optional[int] = typer.Option(None, help='Random seed for down-sampling sequences by lineage'),
+         quality_percentile: float = typer.Option(75.0, help='Percentile of N and gap counts of unique sequences '
+                                                             'to use as cutoffs for higher quality sequences'),
+         adaptive_quality: bool = typer.Option(True, help='Raise the N and gap count percentile cutoffs if fewer '
+                                                          'sequences than required to reach --max-seqs pass them'),
+         collapse_identical: bool = typer.Option(False, help='Only write one representative sequence for each group '
+                                                             'of identical output sequences to the output FASTA'),
+         groups_output: Optional[Path] = typer.Option(None, help='Output table of representative and member samples '
+                                                                 'of identical sequences collapsed with '
+                                                                 '--collapse-identical')):
     """Filter MSA FASTA for user specified and higher quality public sequences up to `max_seqs`"""
     from rich.traceback import install
     install(show_locals=True, width=120, word_wrap=True)
@@ -31,48 +47,74 @@ def main(input_fasta: Path = typer.Option(..., help='FASTA with sequences to fil
     logging.info(f'Reading metadata table "{input_metadata}".')
     df = pd.read_table(input_metadata, index_col=0)
     nrow = df.shape[0]
-    if nrow <= max_seqs:
+    if nrow <= max_seqs and not collapse_identical:
         logging.info(f'MSA sequences ({nrow}) <= {max_seqs}. Creating symlinks...')
         make_symlinks(input_fasta, output_fasta, input_metadata, output_metadata)
+        if groups_output:
+            write_groups(pd.DataFrame(columns=GROUPS_COLUMNS), groups_output)
         logging.info(f'Done!')
         sys.exit(0)
-    logging.info(f'Filtering. {nrow} > {max_seqs} sequences.')
-    sample_seq = read_fasta(input_fasta)
-    seq_samples = seq_to_samples(sample_seq)
+    logging.info(f'Computing sequence digests and N and gap counts for sequences in "{input_fasta}".')
+    df_msa = read_msa_stats(input_fasta)
+    logging.info(f'{df_msa.shape[0]} MSA sequences with {df_msa["digest"].nunique()} unique sequences.')
     keep_samples = init_samples_to_keep(lineage_report, ref_name)
+    user_samples = set(keep_samples)
+    if nrow <= max_seqs:
+        logging.info(f'MSA sequences ({nrow}) <= {max_seqs}. Keeping all sequences.')
+        keep_samples |= set(df_msa.index)
+    else:
+        logging.info(f'Filtering. {nrow} > {max_seqs} sequences.')
+        keep_samples = select_samples(df, df_msa, keep_samples, country, max_seqs, seed=seed,
+                                      quality_percentile=quality_percentile,
+                                      adaptive_quality=adaptive_quality)
+    df_groups = pd.DataFrame(columns=GROUPS_COLUMNS)
+    fasta_samples = keep_samples
+    if collapse_identical:
+        df_groups = identical_sequence_groups(keep_samples, user_samples, df_msa)
+        fasta_samples = keep_samples - set(df_groups['member'])
+        logging.info(f'Collapsed {df_groups.shape[0]} of {len(keep_samples)} sequences into '
+                     f'{df_groups["representative"].nunique()} representatives of identical sequences.')
+    logging.info(f'Writing {len(fasta_samples)} of {df_msa.shape[0]} sequences to "{output_fasta}".')
+    n_written = write_fasta(output_fasta, fasta_samples, input_fasta, df_msa)
+    logging.info(f'Wrote {n_written} sequences to "{output_fasta}".')
+    if groups_output:
+        write_groups(df_groups, groups_output)
+        logging.info(f'Wrote {df_groups.shape[0]} collapsed identical sequences to "{groups_output}".')
+    df.loc[list(keep_samples & set(df.index)), :].to_csv(output_metadata, sep='\t', index=True)
+    logging.info(f'Done!')
+
+
+def select_samples(
+        df: pd.DataFrame,
+        df_msa: pd.DataFrame,
+        keep_samples: Set[str],
+        country: Optional[str],
+        max_seqs: int,
+        seed: Optional[int] = None,
+        quality_percentile: float = 75.0,
+        adaptive_quality: bool = True
+) -> Set[str]:
+    """Select user, country and higher quality sequences up to `max_seqs`"""
     if country and 'country' in df.columns:
         keep_samples = keep_seqs_from_country(df, country, keep_samples, max_seqs)
     elif country:
         logging.warning(f'Country "{country}" to preferentially select sequences from '
                         f'specified, but no column "country" in metadata dataframe!')
-    df_less_n_gaps, keep_samples = quality_filter(keep_samples, seq_samples, df)
+    n_needed = max_seqs - len(keep_samples) if adaptive_quality else None
+    df_less_n_gaps, keep_samples = quality_filter(keep_samples, df, df_msa, n_needed=n_needed,
+                                                  percentile=quality_percentile)
     if (df_less_n_gaps.shape[0] + len(keep_samples)) <= max_seqs:
         keep_samples |= set(df_less_n_gaps['sample'])
     else:
-        keep_samples = sampling_lineages(df_less_n_gaps, keep_samples, max_seqs)
+        keep_samples = sampling_lineages(df_less_n_gaps, keep_samples, max_seqs, seed=seed)
         logging.info(f'Sampled {(len(keep_samples))} samples from top quality sequences.')
-    logging.info(f'Writing {len(keep_samples)} of {len(seq_samples)} sequences to "{output_fasta}".')
-    write_fasta(output_fasta, keep_samples, sample_seq)
-    df.loc[keep_samples & set(df.index), :].to_csv(output_metadata, sep='\t', index=True)
-    logging.info(f'Done!')
+    return keep_samples
 
 
-def sampling_lineages(df: pd.DataFrame, keep_samples: Set[str], max_seqs: int) -> Set[str]:
-    df_lineages_count = df['lineage'].value_counts(ascending=True).to_frame('count')
-    n_lineages = df_lineages_count.shape[0]
-    seqs_per_lineages = int((max_seqs - len(keep_samples)) / n_lineages)
-    for i, (lineage, row) in enumerate(df_lineages_count.iterrows()):
-        seqs_in_lineages = df[df['lineage'] == lineage]
-        if row['count'] < seqs_per_lineages:
-            logging.info(
-                f'No need to sample lineage "{lineage}" (sequences count={row["count"]}; less than {seqs_per_lineages} seqs per lineage)')
-            keep_samples |= set(seqs_in_lineages['sample'])
-        else:
-            logging.info(
-                f'Sampling lineage "{lineage}" sequences (sequences count={row["count"]}; greater than {seqs_per_lineages} seqs per lineage)')
-            keep_samples |= set(seqs_in_lineages['sample'].sample(n=seqs_per_lineages))
-        if n_lineages < i + 1:
-            seqs_per_lineages = (max_seqs - len(keep_samples)) / (n_lineages - i + 1)
+def sampling_lineages(df: pd.DataFrame, keep_samples: Set[str], max_seqs: int, seed: Optional[int] = None) -> Set[str]:
+    n_samples = max(max_seqs - len(keep_samples), 0)
+    sampled = stratified_sample(df, 'lineage', n_samples, rng=np.random.default_rng(seed))
+    keep_samples |= set(df.loc[sampled, 'sample'])
     return keep_samples
 
 
@@ -92,36 +134,121 @@ def keep_seqs_from_country(df: pd.DataFrame, country: str, keep_samples: Set[str
 
 def quality_filter(
         keep_samples: Set[str],
-        seq_samples: Mapping[str, Set[str]],
-        df: pd.DataFrame
+        df: pd.DataFrame,
+        df_msa: pd.DataFrame,
+        n_needed: Optional[int] = None,
+        percentile: float = 75.0
 ) -> Tuple[pd.DataFrame, Set[str]]:
-    seq_recs = []
-    for seq, samples in seq_samples.items():
-        if samples & keep_samples:
-            keep_samples |= samples
-            continue
-        seq = seq.upper()
-        sample: str = list(samples)[0]
-        lineage: str = df.loc[sample, 'Pango_lineage']
-        seq_recs.append(dict(
-            sample=sample,
-            lineage=lineage,
-            seq_n=seq.count('N'),
-            seq_gap=seq.count('-'),
-        ))
-    df_seq_recs = pd.DataFrame(seq_recs)
-    # TODO: more flexible and dynamic sequence quality filtering based on total number of sequences and number of sequences required so that sequences aren't unnecessarily filtered out [peterk87 2021-06-22]
-    df_percentile_75 = df_seq_recs.describe()
-    seq_n_75 = df_percentile_75.loc['75%', 'seq_n']
-    seq_gap_75 = df_percentile_75.loc['75%', 'seq_gap']
-    df_less_n_gaps = df_seq_recs.query('seq_n <= @seq_n_75 and seq_gap <= @seq_gap_75')
+    """Get higher quality unique sequences by N and gap count percentile cutoffs
+
+    Samples with sequences identical to kept samples are also kept. For other unique sequences, the first sample in
+    the MSA with that sequence is considered. Sequences with N and gap counts less than or equal to the `percentile`
+    of the N and gap counts of all considered sequences pass the quality filter. If `n_needed` is specified and fewer
+    sequences pass, the percentile is raised until at least `n_needed` sequences pass.
+
+    Arguments:
+        keep_samples: Samples to keep
+        df: Metadata table with "Pango_lineage" column
+        df_msa: MSA sequence stats from `read_msa_stats`
+        n_needed: Number of sequences required in addition to `keep_samples`
+        percentile: N and gap count percentile cutoff
+
+    Returns:
+        Table of higher quality sequences with sample, lineage, N and gap counts and the updated `keep_samples`
+    """
+    is_kept = df_msa.index.isin(list(keep_samples))
+    in_kept_group = df_msa['digest'].isin(df_msa['digest'].values[is_kept])
+    keep_samples |= set(df_msa.index[in_kept_group])
+    # first sample in MSA with each sequence
+    df_reps = df_msa[~in_kept_group].sort_values('record').drop_duplicates('digest')
+    # lineage of the first metadata row of samples with duplicated metadata rows
+    lineages = df.loc[~df.index.duplicated(), 'Pango_lineage']
+    df_seq_recs = pd.DataFrame(dict(
+        sample=df_reps.index,
+        lineage=lineages.reindex(df_reps.index).values,
+        seq_n=df_reps['seq_n'].values,
+        seq_gap=df_reps['seq_gap'].values,
+    ))
+    if df_seq_recs.empty:
+        return df_seq_recs, keep_samples
+    seq_n = df_seq_recs['seq_n'].values
+    seq_gap = df_seq_recs['seq_gap'].values
+    if n_needed is not None:
+        percentile = adapt_quality_percentile(seq_n, seq_gap, n_needed, percentile)
+    seq_n_cutoff = np.percentile(seq_n, percentile)
+    seq_gap_cutoff = np.percentile(seq_gap, percentile)
+    logging.info(f'Quality filtering {df_seq_recs.shape[0]} unique sequences by {percentile:.2f} percentile N count '
+                 f'(<= {seq_n_cutoff}) and gap count (<= {seq_gap_cutoff}).')
+    df_less_n_gaps = df_seq_recs[(seq_n <= seq_n_cutoff) & (seq_gap <= seq_gap_cutoff)]
     return df_less_n_gaps, keep_samples
 
 
-def write_fasta(fasta_output: Path, keep_samples: Set[str], sample_seq: Dict[str, str]) -> None:
-    with open(fasta_output, 'w') as fout:
-        for sample in keep_samples:
-            fout.write(f'>{sample}\n{sample_seq[sample]}\n')
+def adapt_quality_percentile(seq_n: np.ndarray, seq_gap: np.ndarray, n_needed: int, percentile: float) -> float:
+    """Get lowest percentile at or above `percentile` at which at least `n_needed` sequences pass N and gap cutoffs
+
+    The number of passing sequences never decreases with the percentile, so the percentile is found by bisection.
+    """
+    def n_passing(q: float) -> int:
+        return int(((seq_n <= np.percentile(seq_n, q)) & (seq_gap <= np.percentile(seq_gap, q))).sum())
+
+    if n_passing(percentile) >= n_needed:
+        return percentile
+    if n_passing(100.0) < n_needed:
+        return 100.0
+    low, high = percentile, 100.0
+    while high - low > 0.01:
+        mid = (low + high) / 2
+        if n_passing(mid) >= n_needed:
+            high = mid
+        else:
+            low = mid
+    logging.info(f'Raised N and gap count percentile cutoff from {percentile} to {high:.2f} for at least '
+                 f'{n_needed} sequences to pass quality filtering.')
+    return high
+
+
+def identical_sequence_groups(
+        keep_samples: Set[str],
+        preferred_samples: Set[str],
+        df_msa: pd.DataFrame
+) -> pd.DataFrame:
+    """Group kept samples with identical sequences under one representative sample
+
+    Preferred (reference and user) samples are never collapsed, so that they are always present in a tree built from
+    representative sequences only. Other samples are collapsed into the first preferred sample in the MSA with an
+    identical sequence or otherwise into the first sample in the MSA with an identical sequence.
+
+    Returns:
+        Table of representative and member sample for each kept sample collapsed into a representative
+    """
+    df_kept = df_msa[df_msa.index.isin(list(keep_samples))]
+    df_kept = df_kept.assign(not_preferred=~df_kept.index.isin(list(preferred_samples)))
+    df_kept = df_kept.sort_values(['not_preferred', 'record'])
+    representatives = df_kept.index.to_series().groupby(df_kept['digest'].values, sort=False).transform('first')
+    is_member = df_kept['digest'].duplicated() & df_kept['not_preferred']
+    return pd.DataFrame(dict(representative=representatives.values[is_member.values],
+                             member=df_kept.index[is_member.values]),
+                        columns=GROUPS_COLUMNS)
+
+
+def write_groups(df_groups: pd.DataFrame, groups_output: Path) -> None:
+    df_groups.to_csv(groups_output, sep='\t', index=False)
+
+
+def write_fasta(fasta_output: Path, keep_samples: Set[str], input_fasta: Path, df_msa: pd.DataFrame) -> int:
+    """Second pass over the MSA FASTA writing only the records of samples to keep in MSA order
+
+    Returns:
+        Number of sequences written
+    """
+    keep_records = set(df_msa.loc[df_msa.index.isin(list(keep_samples)), 'record'])
+    n_written = 0
+    with open(fasta_output, 'wb') as fout:
+        for i, (sample, seq) in enumerate(iter_fasta(input_fasta)):
+            if i in keep_records:
+                fout.write(b'>' + sample.encode() + b'\n' + seq + b'\n')
+                n_written += 1
+    return n_written
 
 
 def init_samples_to_keep(lineage_report: Path, ref_name: str) -> Set[str]:
@@ -141,19 +268,30 @@ def make_symlinks(input_fasta: Path,
     logging.info(f'Created symlink "{fasta_output}" to "{input_fasta}"')
 
 
-def read_fasta(fasta: Path) -> Dict[str, str]:
-    out = {}
-    with open(fasta) as fin:
-        for strain, seq in SimpleFastaParser(fin):
-            out[strain] = seq
-    return out
+def read_msa_stats(fasta: Path) -> pd.DataFrame:
+    """First pass over the MSA FASTA computing a sequence content digest and N and gap counts for each record
+
+    Digests are computed on uppercased sequences and N (including lowercase "n") and gap counts with byte lookup
+    tables by `sequence_stats`. Sequences are not kept in memory. As with reading the MSA into a dict, only the last
+    record of a duplicated sample name is kept.
+
+    Returns:
+        Table indexed by sample name with the record number in the FASTA, sequence digest, N count and gap count
+    """
+    records = {}
+    for i, (sample, seq) in enumerate(iter_fasta(fasta)):
+        _, _, seq_n, seq_gap = sequence_stats(seq)
+        records[sample] = (i, hashlib.blake2b(seq.translate(UPPER_TABLE), digest_size=16).digest(), seq_n, seq_gap)
+    return pd.DataFrame(list(records.values()),
+                        index=pd.Index(list(records.keys()), dtype=object),
+                        columns=['record', 'digest', 'seq_n', 'seq_gap'])
 
 
-def seq_to_samples(sample_seq: Dict[str, str]) -> Mapping[str, Set[str]]:
-    seq_samples = defaultdict(set)
-    for sample, seq in sample_seq.items():
-        seq_samples[seq].add(sample)
-    return seq_samples
+def iter_fasta(fasta: Path) -> Iterator[Tuple[str, bytes]]:
+    """Read FASTA records as header and sequence bytes in record-aligned blocks with `parse_fasta_block`"""
+    with open(fasta, 'rb') as fin:
+        for block in iter_fasta_blocks(fin):
+            yield from parse_fasta_block(block)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,82 @@
+"""Stratified down-sampling of sequences by Pangolin lineage shared by filter_gisaid.py and filter_msa.py"""
+import logging
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+
+def allocate_quotas(counts: pd.Series, n: int) -> pd.Series:
+    """Allocate up to `n` samples across groups as evenly as possible
+
+    Groups are visited from smallest to largest. A group with fewer members than its share of the remaining
+    samples is kept whole and its unused share is redistributed to the remaining larger groups.
+
+    Arguments:
+        counts: Number of members of each group
+        n: Total number of samples to allocate
+
+    Returns:
+        Number of members to sample from each group
+    """
+    counts = counts.sort_values(kind='mergesort')
+    quotas = np.zeros(counts.size, dtype='int64')
+    remaining = n
+    for i, count in enumerate(counts.values):
+        share = remaining // (counts.size - i)
+        quotas[i] = min(count, share)
+        remaining -= quotas[i]
+    return pd.Series(quotas, index=counts.index)
+
+
+def stratified_sample(
+        df: pd.DataFrame,
+        group_column: str,
+        n: int,
+        weights: Optional[np.ndarray] = None,
+        rng: Optional[np.random.Generator] = None
+) -> pd.Index:
+    """Sample up to `n` rows of `df` stratified by `group_column` with optional weights
+
+    Weighted sampling without replacement is performed for all groups at once by giving each row a random key
+    drawn from an exponential distribution divided by its weight and keeping the rows with the smallest keys in
+    each group (Efraimidis-Spirakis). Rows with a weight of zero are only sampled if a group has too few rows with
+    non-zero weights to fill its quota, in which case they are sampled with equal probability. Rows with a missing
+    group are never sampled.
+
+    Arguments:
+        df: Table to sample rows from
+        group_column: Column to stratify sampling by
+        n: Max number of rows to sample
+        weights: Optional non-negative sampling weight for each row
+        rng: Random number generator
+
+    Returns:
+        Index of sampled rows
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    groups = df[group_column]
+    counts = groups.value_counts()
+    quotas = allocate_quotas(counts, n)
+    n_sampled_groups = int((quotas < counts.reindex(quotas.index)).sum())
+    logging.info(f'Sampling {quotas.sum()} of {df.shape[0]} rows from {quotas.size} groups by "{group_column}". '
+                 f'{quotas.size - n_sampled_groups} groups kept whole, {n_sampled_groups} groups down-sampled.')
+    draws = rng.exponential(size=df.shape[0])
+    if weights is None:
+        keys = draws
+    else:
+        with np.errstate(divide='ignore'):
+            keys = np.where(weights > 0, draws / weights, np.inf)
+    order = np.lexsort((draws, keys))
+    sorted_groups = groups.iloc[order]
+    ranks = sorted_groups.groupby(sorted_groups, sort=False, observed=True).cumcount()
+    group_quotas = quotas.reindex(sorted_groups.values).values
+    return df.index[order][ranks.values < group_quotas]
+
+
+def n_content_weights(n_content: pd.Series) -> np.ndarray:
+    """Sampling weights favouring sequences with less N content. Missing N content gets a weight of zero."""
+    weights = 1.0 - n_content.astype(float).values
+    weights[np.isnan(weights)] = 0.0
+    return np.clip(weights, 0.0, 1.0)
@@ -1,25 +1,38 @@
 #!/usr/bin/env python3
+import csv
 import logging
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Set, List, IO
 
+import numpy as np
 import pandas as pd
 import typer
 from rich.console import Console
 from rich.logging import RichHandler
 
+from aa_mutation_matrix import read_sparse_matrix, encode_dense_rows
+
+# Max number of table cells (rows x columns) written to the merged table at a time
+BLOCK_CELLS = 1 << 22
+METADATA_CHUNKSIZE = 100000
+
 
 def main(
         metadata_input: Path,
         pangolin_report: Path,
         metadata_output: Path = typer.Option(Path('metadata.merged.tsv')),
-        aa_mutation_matrix: Optional[Path] = typer.Option(None, help='Amino acid mutation matrix TSV'),
+        aa_mutation_matrix: Optional[Path] = typer.Option(None, help='Amino acid mutation matrix (sparse .npz or TSV)'),
         select_metadata_fields: Optional[str] = typer.Option(None,
                                                              help='Comma-delimited list of metadata fields to output. '
                                                                   'If unset, all metadata fields will be output.'),
-        user_metadata: Optional[Path] = typer.Option(None, help='User sequences metadata CSV or tab-delimited table.')
+        user_metadata: Optional[Path] = typer.Option(None, help='User sequences metadata CSV or tab-delimited table.'),
+        leaflist: Optional[Path] = typer.Option(None, help='Only output rows for taxa in this list'),
 ):
-    """Merge a metadata table, Pangolin results table and AA mutation matrix into one table."""
+    """Merge a metadata table, Pangolin results table and AA mutation matrix into one table.
+
+    All tables are restricted to the leaflist taxa (if provided) and aligned on a shared index of taxa. The merged
+    table is written in blocks of rows with the AA mutation matrix expanded from its sparse form one block at a time.
+    """
     from rich.traceback import install
     install(show_locals=True, width=120, word_wrap=True, console=Console(stderr=True))
     logging.basicConfig(
@@ -30,8 +43,10 @@ def main(
                               tracebacks_show_locals=True,
                               console=Console(stderr=True))],
     )
-    df_metadata = pd.read_table(metadata_input, dtype=str)
-    df_metadata.set_index(df_metadata.columns[0], inplace=True)
+    taxa = read_leaflist(leaflist) if leaflist else None
+    if taxa is not None:
+        logging.info(f'Restricting tables to {len(taxa)} taxa in leaflist "{leaflist}"')
+    df_metadata = read_metadata(metadata_input, taxa)
     logging.info(f'Read metadata table "{metadata_input}" with '
                  f'{df_metadata.shape[0]} rows and {df_metadata.shape[1]} columns')
     if select_metadata_fields:
@@ -42,6 +57,8 @@ def main(
         logging.info(f'Reading user metadata table from "{user_metadata}". Assuming first column contains user '
                      f'sequence IDs/names.')
         df_user = read_user_metadata(user_metadata)
+        if df_user is not None and taxa is not None:
+            df_user = df_user[df_user.index.isin(taxa)]
         if df_user is not None:
             logging.info(f'Combining user metadata table with shape {df_user.shape} '
                          f'(columns={df_user.columns.tolist()}) with GISAID metadata table '
@@ -49,20 +66,90 @@ def main(
             df_metadata = df_user.combine_first(df_metadata)
         else:
             logging.warning(f'Empty user metadata table from "{user_metadata}"')
-    dfs = [df_metadata]
     df_pangolin = read_pangolin_report(pangolin_report)
-    dfs.append(df_pangolin)
-    if aa_mutation_matrix:
-        dfs.append(pd.read_table(aa_mutation_matrix, index_col=0, dtype=str))
-    logging.info(f'Merging {len(dfs)} dataframes on index')
-    df_merged = pd.concat(dfs, axis=1)
+    if taxa is not None:
+        df_pangolin = df_pangolin[df_pangolin.index.isin(taxa)]
+    dfs = [df_metadata, df_pangolin]
+    aa_matrix = None
+    if aa_mutation_matrix and aa_mutation_matrix.suffix == '.npz':
+        aa_matrix = read_sparse_matrix(aa_mutation_matrix)
+    elif aa_mutation_matrix:
+        df_aa = pd.read_table(aa_mutation_matrix, index_col=0, dtype=str)
+        dfs.append(df_aa[df_aa.index.isin(taxa)] if taxa is not None else df_aa)
+    index = merged_index([df.index for df in dfs] + ([pd.Index(aa_matrix[2])] if aa_matrix else []), taxa)
+    logging.info(f'Merging {len(dfs) + (aa_matrix is not None)} tables on index of {index.size} taxa')
+    df_merged = pd.concat([df.reindex(index) for df in dfs], axis=1)
     if 'Pango_lineage' in df_merged.columns:
         df_merged['Pango_lineage'] = df_merged['Pango_lineage'].combine_first(df_pangolin['lineage'])
     if 'Pangolin_version' in df_merged.columns:
         df_merged['Pangolin_version'] = df_merged['Pangolin_version'].combine_first(df_pangolin['pangoLEARN_version'])
-    logging.info(f'Writing merged dataframe with shape {df_merged.shape} to "{metadata_output}".')
-    df_merged.to_csv(metadata_output, sep='\t', index=True)
-    logging.info(f'Wrote merged dataframe with shape {df_merged.shape} to "{metadata_output}".')
+    n_columns = df_merged.shape[1] + (len(aa_matrix[3]) if aa_matrix else 0)
+    logging.info(f'Writing merged table with {index.size} rows and {n_columns} columns to "{metadata_output}".')
+    with open(metadata_output, 'w', newline='') as fout:
+        write_merged(fout, df_merged, aa_matrix)
+    logging.info(f'Wrote merged table with {index.size} rows and {n_columns} columns to "{metadata_output}".')
+
+
+def read_leaflist(leaflist: Path) -> Set[str]:
+    with open(leaflist) as fh:
+        return {line.strip() for line in fh if line.strip()}
+
+
+def read_metadata(metadata_input: Path, taxa: Optional[Set[str]] = None) -> pd.DataFrame:
+    """Read a tab-delimited metadata table indexed by its first column, keeping only rows for `taxa` if specified"""
+    if taxa is None:
+        df = pd.read_table(metadata_input, dtype=str)
+    else:
+        df = pd.concat([chunk[chunk.iloc[:, 0].isin(taxa)]
+                        for chunk in pd.read_table(metadata_input, dtype=str, chunksize=METADATA_CHUNKSIZE)])
+    df.set_index(df.columns[0], inplace=True)
+    return df
+
+
+def merged_index(indexes: List[pd.Index], taxa: Optional[Set[str]] = None) -> pd.Index:
+    """Union of indexes in order of first appearance, restricted to `taxa` if specified"""
+    index = pd.Index(pd.unique(np.concatenate([x.values.astype(object) for x in indexes])))
+    if taxa is not None:
+        index = index[index.isin(taxa)]
+    return index
+
+
+def write_merged(fout: IO[str], df_merged: pd.DataFrame, aa_matrix=None) -> None:
+    """Write merged table followed by dense AA mutation matrix columns in blocks of rows
+
+    Rows are formatted with the `csv` module like `DataFrame.to_csv`. AA mutation matrix rows are encoded from
+    the sparse matrix for each block, with empty values for taxa not in the matrix.
+    """
+    aa_columns = []
+    aa_rows = np.full(df_merged.shape[0], -1, dtype=np.int64)
+    if aa_matrix is not None:
+        indptr, indices, samples, aa_columns = aa_matrix
+        aa_rows = pd.Index(samples).get_indexer(df_merged.index)
+    missing_aas = '\t' * len(aa_columns)
+    lines = []
+    writer = csv.writer(LineCollector(lines), delimiter='\t', lineterminator='')
+    writer.writerow([''] + list(df_merged.columns) + aa_columns)
+    fout.write(lines.pop() + '\n')
+    block_size = max(1, BLOCK_CELLS // max(1, df_merged.shape[1] + len(aa_columns)))
+    for start in range(0, df_merged.shape[0], block_size):
+        df_block = df_merged.iloc[start:start + block_size]
+        writer.writerows(df_block.reset_index().fillna('').values.tolist())
+        block_aa_rows = aa_rows[start:start + block_size]
+        aa_text = [missing_aas] * block_aa_rows.size
+        present = np.flatnonzero(block_aa_rows >= 0)
+        if present.size:
+            encoded = encode_dense_rows(indptr, indices, block_aa_rows[present], len(aa_columns))
+            for i, row in zip(present.tolist(), encoded):
+                aa_text[i] = row.tobytes().decode()
+        fout.write(''.join(line + aa + '\n' for line, aa in zip(lines, aa_text)))
+        lines.clear()
+
+
+class LineCollector:
+    """File-like target for `csv.writer` that collects each written row as a separate string"""
+
+    def __init__(self, lines: List[str]):
+        self.write = lines.append
 
 
 def read_user_metadata(user_metadata: Path) -> Optional[pd.DataFrame]:
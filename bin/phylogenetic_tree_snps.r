@@ -11,6 +11,41 @@ scale_y_tree <- function(expand=expand_scale(0, 0.6), ...){
   scale_y_continuous(expand=expand, ...)
 }
 
+# read variant list written by align2alleles.py --sparse-output
+# see SPARSE_MAGIC in align2alleles.py for a description of the format
+read_sparse_alleles <- function(path)
+{
+  con <- file(path, "rb")
+  on.exit(close(con))
+  magic <- readBin(con, "raw", n=4)
+  if(!identical(rawToChar(magic), "A2AS")) {
+    stop(paste("not an align2alleles.py sparse variant list:", path))
+  }
+  header <- readBin(con, "integer", n=3, size=4, endian="little")
+  n_calls <- header[3]
+  sample_names <- readBin(con, "character", n=header[2])
+  sample <- readBin(con, "integer", n=n_calls, size=4, endian="little")
+  pos <- readBin(con, "integer", n=n_calls, size=4, endian="little")
+  ref_allele <- readBin(con, "integer", n=n_calls, size=1, signed=FALSE)
+  alt_allele <- readBin(con, "integer", n=n_calls, size=1, signed=FALSE)
+  samples_with_allele <- readBin(con, "integer", n=n_calls, size=4, endian="little")
+  data.frame(name=sample_names[sample + 1],
+             pos=pos,
+             ref_allele=rawToChar(as.raw(ref_allele), multiple=TRUE),
+             alt_allele=rawToChar(as.raw(alt_allele), multiple=TRUE),
+             samples_with_allele=samples_with_allele,
+             stringsAsFactors=FALSE)
+}
+
+# read variant list TSV or sparse binary variant list output by align2alleles.py
+read_alleles <- function(path)
+{
+  if(grepl("\\.bin$", path)) {
+    return(read_sparse_alleles(path))
+  }
+  read.table(path, header=T)
+}
+
 # 
 plot_tree_with_snps <- function(tree, alleles, lineage_path)
 {
@@ -106,7 +141,7 @@ if(!interactive()) {
     }
 
     tree <- read.tree(tree_path)
-    alleles <- read.table(alleles_path, header=T)
+    alleles <- read_alleles(alleles_path)
     p <- plot_tree_with_snps(tree, alleles, lineage_path)
     
     # count number of samples, for scaling the plot
@@ -1,18 +1,35 @@
 #!/usr/bin/env python3
 import logging
-from pathlib import Path
 import re
-import gzip
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Dict, List, Tuple, Optional, IO, ContextManager
 
 import typer
-from Bio.SeqIO.FastaIO import SimpleFastaParser
 from rich.logging import RichHandler
 
+from sequence_io import iter_fasta_blocks, open_decompressed, parse_fasta_block, sequence_stats
+
+# Sequence IDs are FASTA headers truncated at the first "|" or whitespace character
+HEADER_END = re.compile(r'[|\s]')
+DUPLICATES_COLUMNS = ['sequence_id', 'header', 'first_header']
+QC_COLUMNS = ['sample', 'length', 'n_ambiguous', 'n_N', 'n_gaps', 'n_fraction', 'passed_qc']
+
 
 def main(
     sequences: Path,
     fasta_output: Path = typer.Option(Path('input_sequences.correctedID.fasta'),
                                           help='FASTA Sequences with correct ID for Pangolin Analysis.'),
+    duplicates_output: Path = typer.Option(None,
+                                           help='Table of sequences with a corrected ID shared with a previous '
+                                                'sequence.'),
+    threads: int = typer.Option(1, help='Number of threads for decompressing input sequences.'),
+    qc_output: Path = typer.Option(None, help='Per sequence QC table (length, ambiguous base, N and gap counts).'),
+    min_length: int = typer.Option(0, help='Sequences shorter than this fail QC.'),
+    max_n_fraction: float = typer.Option(1.0, help='Sequences with a higher fraction of N bases fail QC.'),
+    max_ambig: int = typer.Option(None, help='Sequences with more ambiguous bases (non "A", "C", "G", "T" or gap) '
+                                             'fail QC.'),
+    drop_failed: bool = typer.Option(False, help='Remove sequences failing QC from the FASTA output.'),
 ):
     from rich.traceback import install
     install(show_locals=True, width=200, word_wrap=True)
@@ -22,19 +39,101 @@ def main(
         level=logging.INFO,
         handlers=[RichHandler(rich_tracebacks=True, tracebacks_show_locals=True, locals_max_string=200)],
     )
-    with open(fasta_output, 'w') as fout:
-        if '.gz' in Path(sequences).suffixes:
-            logging.info(f'Input Sequences {sequences} in gz format provided')
-            with gzip.open(sequences, 'rt') as fin:
-                for name, seq in SimpleFastaParser(fin):
-                    header = re.sub(r'[\|\s].*$', "", name)
-                    fout.write(f'>{header}\n{seq}\n')
-        else:
-            logging.info(f'Input Sequences {sequences} in unzip format provided')
-            with open(sequences, 'rt') as fin:
-                for name, seq in SimpleFastaParser(fin):
-                    header = re.sub(r'[\|\s].*$', "", name)
-                    fout.write(f'>{header}\n{seq}\n')
+    logging.info(f'Reading input sequences from "{sequences}"')
+    n_seqs, n_failed, duplicates = prepare_sequences(sequences, fasta_output, qc_output, threads, min_length,
+                                                     max_n_fraction, max_ambig, drop_failed)
+    logging.info(f'{n_failed} of {n_seqs} sequences failed QC (min length={min_length}, '
+                 f'max N fraction={max_n_fraction}, max ambiguous bases={max_ambig}).')
+    if drop_failed:
+        logging.info(f'Wrote {n_seqs - n_failed} sequences passing QC with corrected IDs to "{fasta_output}"')
+        if n_failed == n_seqs:
+            logging.error('No input sequences passed QC!')
+            raise typer.Exit(1)
+    else:
+        logging.info(f'Wrote {n_seqs} sequences with corrected IDs to "{fasta_output}"')
+    if duplicates:
+        logging.warning(f'{len(duplicates)} sequences have a corrected ID shared with a previous sequence: '
+                        f'{", ".join(seq_id for seq_id, _, _ in duplicates[:10])}'
+                        f'{", ..." if len(duplicates) > 10 else ""}')
+    if duplicates_output:
+        write_duplicates(duplicates_output, duplicates)
+
+
+def prepare_sequences(
+        sequences: Path,
+        fasta_output: Path,
+        qc_output: Optional[Path] = None,
+        threads: int = 1,
+        min_length: int = 0,
+        max_n_fraction: float = 1.0,
+        max_ambig: Optional[int] = None,
+        drop_failed: bool = False,
+) -> Tuple[int, int, List[Tuple[str, str, str]]]:
+    """Write sequences with IDs truncated at the first "|" or whitespace character and QC stats for each sequence
+
+    Plain, gzip/bgzip, xz or zstd compressed FASTA is detected from its leading bytes and read in large
+    record-aligned blocks. Sequence QC stats are counted with byte lookup tables and sequence IDs are checked for
+    duplicates as they are written.
+
+    Arguments:
+        sequences: Input FASTA path
+        fasta_output: Output FASTA path
+        qc_output: Optional output QC table path
+        threads: Number of threads for external decompressor
+        min_length: Min sequence length to pass QC
+        max_n_fraction: Max fraction of N bases to pass QC
+        max_ambig: Max number of ambiguous bases to pass QC
+        drop_failed: Do not write sequences failing QC to `fasta_output`
+
+    Returns:
+        Number of sequences, number of sequences failing QC and (sequence ID, header, first header with ID) for
+        each duplicate ID
+    """
+    first_headers: Dict[str, str] = {}
+    duplicates = []
+    n_seqs = 0
+    n_failed = 0
+    with open_decompressed(sequences, threads) as fin, open(fasta_output, 'wb') as fout, \
+            open_qc_output(qc_output) as qc_out:
+        for block in iter_fasta_blocks(fin):
+            lines = []
+            qc_lines = []
+            for header, seq in parse_fasta_block(block):
+                seq_id = HEADER_END.split(header, 1)[0]
+                if seq_id in first_headers:
+                    duplicates.append((seq_id, header, first_headers[seq_id]))
+                else:
+                    first_headers[seq_id] = header
+                length, n_ambiguous, n_n, n_gaps = sequence_stats(seq)
+                n_fraction = n_n / length if length else 1.0
+                passed = (length >= min_length
+                          and n_fraction <= max_n_fraction
+                          and (max_ambig is None or n_ambiguous <= max_ambig))
+                n_seqs += 1
+                if not passed:
+                    n_failed += 1
+                qc_lines.append(f'{seq_id}\t{length}\t{n_ambiguous}\t{n_n}\t{n_gaps}\t{n_fraction:.6g}\t{passed}\n')
+                if passed or not drop_failed:
+                    lines.append(b'>%s\n%s\n' % (seq_id.encode(), seq))
+            fout.write(b''.join(lines))
+            if qc_out is not None:
+                qc_out.write(''.join(qc_lines))
+    return n_seqs, n_failed, duplicates
+
+
+def open_qc_output(qc_output: Optional[Path]) -> ContextManager[Optional[IO[str]]]:
+    if qc_output is None:
+        return nullcontext()
+    fout = open(qc_output, 'w')
+    fout.write('\t'.join(QC_COLUMNS) + '\n')
+    return fout
+
+
+def write_duplicates(path: Path, duplicates: List[Tuple[str, str, str]]) -> None:
+    with open(path, 'w') as fout:
+        fout.write('\t'.join(DUPLICATES_COLUMNS) + '\n')
+        for row in duplicates:
+            fout.write('\t'.join(row) + '\n')
 
 
 if __name__ == "__main__":
@@ -1,15 +1,38 @@
 #!/usr/bin/env python3
+import heapq
 import logging
 import sys
 from pathlib import Path
-from typing import Iterable, Set, Dict, Tuple, List
+from typing import Iterable, Set, Tuple, List, Optional, NamedTuple
 
+import numpy as np
 import pandas as pd
 import typer
-from Bio import Phylo
-from Bio.Phylo.Newick import Tree, Clade
 from rich.logging import RichHandler
 
+from tree_arrays import TreeArrays, read_newick, write_newick, add_tip_children
+
+# Neighboring taxa selection modes: nearest taxa to each user taxon or taxa maximizing phylogenetic diversity
+SELECTION_MODES = ['nearest', 'diversity']
+
+
+class TreeIndex(NamedTuple):
+    """Tree nodes numbered in preorder (root is 0) with per-node arrays for fast distance queries
+
+    The subtree of node `i` spans nodes `i` to `i + subtree_size[i] - 1`. Lowest common ancestors (LCA) are found
+    with a range minimum query over the Euler tour of the tree using a sparse table.
+    """
+    names: List[Optional[str]]
+    parent: np.ndarray
+    depth: np.ndarray
+    is_tip: np.ndarray
+    n_tips: np.ndarray
+    subtree_size: np.ndarray
+    euler_first: np.ndarray
+    euler_nodes: np.ndarray
+    euler_levels: np.ndarray
+    sparse_table: np.ndarray
+
 
 def main(
     newick_tree_input: Path,
@@ -19,6 +42,16 @@ def main(
     leaflist: Path = typer.Option(Path('leaflist'), help='List of leaves/taxa to filter for in shiptv tree'),
     metadata_output: Path = typer.Option('metadata.leaflist.tsv', help='Metadata for leaflist taxa'),
     max_taxa: int = typer.Option(100, help="Max taxa in leaflist"),
+    max_neighbors_per_taxon: int = typer.Option(0, help="Max neighboring taxa to select for each user taxon. "
+                                                        "No limit if 0."),
+    selection_mode: str = typer.Option('nearest', help="Select nearest neighboring taxa of each user taxon "
+                                                        "('nearest') or neighboring taxa maximizing phylogenetic "
+                                                        "diversity ('diversity')"),
+    groups: Optional[Path] = typer.Option(None, help="Table of representative and member taxa of identical "
+                                                     "sequences collapsed before tree building. Members are "
+                                                     "re-added to the tree as zero length branch siblings of "
+                                                     "their representative."),
+    tree_output: Optional[Path] = typer.Option(None, help="Output tree with collapsed identical taxa re-added"),
 ):
     """Prune phylo tree to taxa neighboring user taxa"""
     from rich.traceback import install
@@ -29,17 +62,34 @@ def main(
         level=logging.INFO,
         handlers=[RichHandler(rich_tracebacks=True, tracebacks_show_locals=True)],
     )
+    if selection_mode not in SELECTION_MODES:
+        logging.error(f'Unknown selection mode "{selection_mode}". Must be one of {SELECTION_MODES}')
+        sys.exit(1)
+    if selection_mode == 'diversity' and max_neighbors_per_taxon:
+        logging.warning(f'Max neighbors per taxon ({max_neighbors_per_taxon}) is ignored with selection mode '
+                        f'"{selection_mode}". It only applies to selection mode "nearest".')
     df = pd.read_table(metadata_input, dtype=str)
     df.set_index(df.columns[0], inplace=True)
     logging.info(f'Read metadata table "{metadata_input}" with {df.shape[0]} rows.')
-    tree: Tree = Phylo.read(newick_tree_input, "newick")
-    n_taxa = tree.count_terminals()
-    logging.info(f'Read tree "{newick_tree_input}" with {n_taxa}.')
+    tree = read_newick(newick_tree_input)
+    n_taxa = tree.n_tips
+    logging.info(f'Read tree "{newick_tree_input}" with {n_taxa} taxa.')
+    df_groups = pd.read_table(groups, dtype=str) if groups else None
+    if df_groups is not None and not df_groups.empty:
+        tree, n_expanded = expand_identical_taxa(tree, df_groups)
+        n_taxa = tree.n_tips
+        logging.info(f'Re-added {n_expanded} taxa with sequences identical to taxa in tree. {n_taxa} taxa in tree.')
+        if tree_output:
+            write_newick(tree, tree_output)
+            logging.info(f'Wrote tree with re-added identical taxa to "{tree_output}".')
+    elif tree_output:
+        logging.info(f'No collapsed identical taxa. Symlinking "{tree_output}" to "{newick_tree_input}".')
+        tree_output.symlink_to(newick_tree_input.resolve())
     if n_taxa <= max_taxa:
         logging.info(f'No pruning of tree required. Number of taxa ({n_taxa}) '
                      f'less than/equal to max taxa desired in tree ({max_taxa}). '
                      f'Writing leaflist "{leaflist}" with all {n_taxa} taxa.')
-        write_leaflist((n.name for n in tree.get_terminals()), leaflist)
+        write_leaflist(tree.tip_names(), leaflist)
         logging.info(f'Symlinking "{metadata_output}" to "{metadata_input}".')
         metadata_output.symlink_to(metadata_input.resolve())
         sys.exit(0)
@@ -48,8 +98,12 @@ def main(
     logging.info(f'Read Pangolin lineage report with {df_pangolin.index.size} rows.')
     user_taxa = set(df_pangolin.index.astype(str))
     logging.info(f'User taxa in tree determined to be {user_taxa}')
-    logging.info(f'Getting neighboring nodes for user taxa up to {max_taxa} taxa in total.')
-    clade_neighbors = get_neighbors(tree, user_taxa, max_taxa - 1)
+    logging.info(f'Getting neighboring nodes for user taxa up to {max_taxa} taxa in total '
+                 f'(selection mode "{selection_mode}").')
+    if selection_mode == 'diversity':
+        clade_neighbors = get_diverse_neighbors(tree, user_taxa, max_taxa - 1)
+    else:
+        clade_neighbors = get_neighbors(tree, user_taxa, max_taxa - 1, max_neighbors_per_taxon or None)
     logging.info(f'Found {len(clade_neighbors - user_taxa)} neighboring taxa to {len(user_taxa)} '
                  f'user taxa. Writing leaf list.')
     clade_neighbors.add(ref_name)
@@ -57,34 +111,270 @@ def main(
     df.loc[list(clade_neighbors & set(df.index)), :].to_csv(metadata_output, sep="\t")
 
 
+def expand_identical_taxa(tree: TreeArrays, df_groups: pd.DataFrame) -> Tuple[TreeArrays, int]:
+    """Re-add member taxa of identical sequence groups as zero length branch siblings of their representative
+
+    Each representative leaf becomes an internal node with zero length branches to the representative and members.
+
+    Returns:
+        Tree with member taxa added and number of member taxa added to the tree
+    """
+    name_node = tree.tip_index()
+    node_children = {}
+    n_added = 0
+    for representative, df_members in df_groups.groupby('representative', sort=False):
+        node = name_node.get(representative)
+        if node is None:
+            logging.warning(f'Representative taxon "{representative}" of identical sequences not found in tree. '
+                            f'Skipping {df_members.shape[0]} members.')
+            continue
+        members = list(df_members['member'])
+        node_children[node] = [representative] + members
+        n_added += len(members)
+    return add_tip_children(tree, node_children), n_added
+
+
+def index_tree(tree: TreeArrays) -> TreeIndex:
+    """Build a TreeIndex from a tree in preorder node arrays
+
+    Root-to-node depths and levels are computed in one preorder pass, subtree tip counts and sizes in one postorder
+    pass and the Euler tour from the preorder parent indices.
+    """
+    parent = tree.parent
+    branch_length = np.nan_to_num(tree.branch_length)
+    n = parent.size
+    depth = np.zeros(n, dtype=float)
+    level = np.zeros(n, dtype=np.int64)
+    for i in range(1, n):
+        depth[i] = depth[parent[i]] + branch_length[i]
+        level[i] = level[parent[i]] + 1
+    n_tips = tree.is_tip.astype(np.int64)
+    subtree_size = np.ones(n, dtype=np.int64)
+    for i in range(n - 1, 0, -1):
+        n_tips[parent[i]] += n_tips[i]
+        subtree_size[parent[i]] += subtree_size[i]
+    euler_first = np.zeros(n, dtype=np.int64)
+    euler = [0]
+    stack = [0]
+    for i in range(1, n):
+        while stack[-1] != parent[i]:
+            stack.pop()
+            euler.append(stack[-1])
+        stack.append(i)
+        euler_first[i] = len(euler)
+        euler.append(i)
+    while len(stack) > 1:
+        stack.pop()
+        euler.append(stack[-1])
+    euler_nodes = np.array(euler, dtype=np.int64)
+    euler_levels = level[euler_nodes]
+    return TreeIndex(tree.names, parent, depth, tree.is_tip, n_tips, subtree_size, euler_first, euler_nodes, euler_levels,
+                     build_sparse_table(euler_levels))
+
+
+def build_sparse_table(values: np.ndarray) -> np.ndarray:
+    """Sparse table where row k, column i is the index of the minimum of values[i:i + 2**k]"""
+    m = values.size
+    table = [np.arange(m, dtype=np.int32)]
+    k = 1
+    while (1 << k) <= m:
+        prev = table[-1]
+        half = 1 << (k - 1)
+        left = prev[:m - half]
+        right = prev[half:]
+        row = np.where(values[left] <= values[right], left, right)
+        table.append(np.concatenate([row, prev[m - half:]]))
+        k += 1
+    return np.vstack(table)
+
+
+def lowest_common_ancestors(index: TreeIndex, node: int, others: np.ndarray) -> np.ndarray:
+    """Get the LCA of `node` and each of `others` with range minimum queries over the Euler tour"""
+    a = index.euler_first[node]
+    b = index.euler_first[others]
+    lo = np.minimum(a, b)
+    hi = np.maximum(a, b)
+    k = np.floor(np.log2(hi - lo + 1)).astype(np.int64)
+    left = index.sparse_table[k, lo]
+    right = index.sparse_table[k, hi - (1 << k) + 1]
+    mins = np.where(index.euler_levels[left] <= index.euler_levels[right], left, right)
+    return index.euler_nodes[mins]
+
+
+def enclosing_clade(index: TreeIndex, node: int, max_taxa: int) -> int:
+    """Get the smallest clade containing a node with more than `max_taxa` taxa (or the largest clade below the root)"""
+    clade = node
+    while index.parent[clade] > 0:
+        clade = index.parent[clade]
+        if index.n_tips[clade] > max_taxa:
+            break
+    return clade
+
+
+def clade_members(index: TreeIndex, clade: int) -> np.ndarray:
+    members = np.arange(clade, clade + index.subtree_size[clade])
+    return members[index.is_tip[members]]
+
+
 def get_clade_member_distances(
-        tree: Tree,
-        name_node: Dict[str, Clade],
-        tax: str,
+        index: TreeIndex,
+        node: int,
         max_taxa: int
 ) -> List[Tuple[float, str]]:
-    user_node = name_node[tax]
-    clade = user_node
-    for clade in tree.get_path(user_node)[::-1]:
-        if clade.count_terminals() > max_taxa:
-            break
-    return sorted((tree.distance(user_node, x), x.name) for x in clade.get_terminals() if x != user_node)
+    """Get the `max_taxa` nearest taxa to a taxon sorted by distance and name
 
+    Candidates are the taxa in the smallest clade containing the taxon with more than `max_taxa` taxa (or the
+    largest clade below the root). Distances are `depth[a] + depth[b] - 2 * depth[lca(a, b)]`.
+    """
+    members = clade_members(index, enclosing_clade(index, node, max_taxa))
+    members = members[members != node]
+    lcas = lowest_common_ancestors(index, node, members)
+    dists = index.depth[node] + index.depth[members] - 2 * index.depth[lcas]
+    if dists.size > max_taxa:
+        # keep all taxa tied with the farthest of the nearest taxa so that ties are broken by name
+        keep = dists <= np.partition(dists, max_taxa - 1)[max_taxa - 1]
+        dists = dists[keep]
+        members = members[keep]
+    return sorted(zip(dists.tolist(), (index.names[i] for i in members)))[:max_taxa]
 
-def get_neighbors(tree: Tree, user_taxa: Set[str], max_taxa: int) -> Set[str]:
-    name_node = {x.name: x for x in tree.get_terminals()}
-    logging.info(f'Calculating branch distances between {len(user_taxa)} user taxa and neighboring taxa.')
-    user_tax_to_distances = {tax: get_clade_member_distances(tree, name_node, tax, max_taxa=max_taxa)
-                             for tax in user_taxa}
+
+def get_neighbors(
+        tree: TreeArrays,
+        user_taxa: Set[str],
+        max_taxa: int,
+        max_neighbors_per_taxon: Optional[int] = None
+) -> Set[str]:
+    """Select the nearest neighboring taxa of user taxa in round-robin order up to `max_taxa` taxa in total
+
+    A priority queue holds the next nearest candidate of each user taxon keyed by the number of taxa already selected
+    for that user taxon then by distance, so each round selects one new taxon per user taxon, nearest first.
+    Selection stops at exactly `max_taxa` taxa or when all candidates are exhausted.
+
+    Arguments:
+        tree: Tree
+        user_taxa: User taxa
+        max_taxa: Max number of taxa to select including user taxa
+        max_neighbors_per_taxon: Optional max number of neighboring taxa to select for each user taxon
+
+    Returns:
+        User taxa and selected neighboring taxa
+    """
+    index = index_tree(tree)
+    name_node = tree.tip_index()
+    missing_taxa = user_taxa - set(name_node)
+    if missing_taxa:
+        logging.warning(f'{len(missing_taxa)} user taxa not found in tree: {missing_taxa}')
     leaflist = set() | user_taxa
-    n_terminals = tree.count_terminals()
-    max_taxa = min(max_taxa, n_terminals)
-    while len(leaflist) < max_taxa:
-        for user_tax, dists in user_tax_to_distances.items():
-            if not dists:
-                continue
-            dist, name = dists.pop(0)
+    n_taxa = min(max_taxa, tree.n_tips)
+    if len(leaflist) >= n_taxa:
+        return leaflist
+    logging.info(f'Calculating branch distances between {len(user_taxa)} user taxa and neighboring taxa.')
+    user_tax_to_distances = {tax: get_clade_member_distances(index, name_node[tax], max_taxa=max_taxa)
+                             for tax in sorted(user_taxa) if tax in name_node}
+    # (number of taxa selected for user taxon, distance, user taxon, candidate index)
+    queue = [(0, dists[0][0], tax, 0) for tax, dists in user_tax_to_distances.items() if dists]
+    heapq.heapify(queue)
+    while queue and len(leaflist) < n_taxa:
+        n_selected, _, tax, i = heapq.heappop(queue)
+        dists = user_tax_to_distances[tax]
+        name = dists[i][1]
+        if name not in leaflist:
             leaflist.add(name)
+            n_selected += 1
+        if i + 1 < len(dists) and (max_neighbors_per_taxon is None or n_selected < max_neighbors_per_taxon):
+            heapq.heappush(queue, (n_selected, dists[i + 1][0], tax, i + 1))
+    if len(leaflist) < n_taxa:
+        logging.info(f'Neighboring taxa candidates exhausted with {len(leaflist)} of {n_taxa} taxa selected.')
+    return leaflist
+
+
+class SpanningTree:
+    """Subtree spanning a set of taxa for computing the phylogenetic diversity (PD) gained by adding a taxon
+
+    Nodes in the spanning subtree are marked 1 and ancestors of its top node are marked 2. The PD gained by adding a
+    taxon is the branch length from the taxon up to the first marked node, plus the branch length from that node
+    down to the top node if the taxon is outside the subtree of the top node.
+    """
+
+    def __init__(self, index: TreeIndex, node: int):
+        self.index = index
+        self.state = np.zeros(index.parent.size, dtype=np.int8)
+        self.state[node] = 1
+        self.top = node
+        self._mark(index.parent[node], 2, -1)
+
+    def _mark(self, node: int, state: int, stop: int) -> None:
+        parent = self.index.parent
+        while node != stop and node >= 0 and self.state[node] != state:
+            self.state[node] = state
+            node = parent[node]
+
+    def _attachment(self, node: int) -> int:
+        parent = self.index.parent
+        while self.state[node] == 0:
+            node = parent[node]
+        return node
+
+    def gain(self, node: int) -> float:
+        depth = self.index.depth
+        attachment = self._attachment(node)
+        pd_gain = depth[node] - depth[attachment]
+        if self.state[attachment] == 2:
+            pd_gain += depth[self.top] - depth[attachment]
+        return pd_gain
+
+    def add(self, node: int) -> None:
+        attachment = self._attachment(node)
+        if self.state[attachment] == 2:
+            self._mark(self.index.parent[self.top], 1, attachment)
+            self.state[attachment] = 1
+            self.top = attachment
+        self._mark(node, 1, attachment)
+
+
+def get_diverse_neighbors(tree: TreeArrays, user_taxa: Set[str], max_taxa: int) -> Set[str]:
+    """Select neighboring taxa of user taxa maximizing phylogenetic diversity up to `max_taxa` taxa in total
+
+    Candidates are the taxa in the clade around each user taxon searched by `get_neighbors`. Taxa are added greedily
+    by the PD they add to the subtree spanning user taxa and already selected taxa. PD gains only decrease as taxa
+    are added, so gains are recomputed lazily for the best candidate in a priority queue.
+
+    Arguments:
+        tree: Tree
+        user_taxa: User taxa
+        max_taxa: Max number of taxa to select including user taxa
+
+    Returns:
+        User taxa and selected neighboring taxa
+    """
+    index = index_tree(tree)
+    name_node = tree.tip_index()
+    missing_taxa = user_taxa - set(name_node)
+    if missing_taxa:
+        logging.warning(f'{len(missing_taxa)} user taxa not found in tree: {missing_taxa}')
+    user_nodes = sorted(name_node[tax] for tax in user_taxa if tax in name_node)
+    leaflist = set() | user_taxa
+    n_taxa = min(max_taxa, tree.n_tips)
+    if len(leaflist) >= n_taxa or not user_nodes:
+        return leaflist
+    candidates = np.unique(np.concatenate([clade_members(index, enclosing_clade(index, node, max_taxa))
+                                           for node in user_nodes]))
+    candidates = np.setdiff1d(candidates, user_nodes)
+    logging.info(f'Selecting taxa maximizing phylogenetic diversity from {candidates.size} candidate taxa around '
+                 f'{len(user_nodes)} user taxa in tree.')
+    spanning_tree = SpanningTree(index, user_nodes[0])
+    for node in user_nodes[1:]:
+        spanning_tree.add(node)
+    queue = [(-spanning_tree.gain(node), index.names[node], node) for node in candidates.tolist()]
+    heapq.heapify(queue)
+    while queue and len(leaflist) < n_taxa:
+        _, name, node = heapq.heappop(queue)
+        pd_gain = spanning_tree.gain(node)
+        if queue and pd_gain < -queue[0][0]:
+            heapq.heappush(queue, (-pd_gain, name, node))
+            continue
+        spanning_tree.add(node)
+        leaflist.add(name)
     return leaflist
 
 
@@ -0,0 +1,202 @@
+"""Reading (compressed) FASTA files as blocks of bytes and computing sequence QC stats with lookup tables
+
+Shared by filter_gisaid.py, prepare_input_sequences.py, filter_msa.py and align2alleles.py.
+"""
+import gzip
+import io
+import logging
+import lzma
+import shutil
+import subprocess
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Tuple, Optional, IO, List, Callable, Iterable
+
+import numpy as np
+
+# Lookup tables indexed by byte value for counting ambiguous bases (non-ACGT including N), N and gaps
+AMBIGUOUS_BYTES = np.ones(256, dtype=bool)
+AMBIGUOUS_BYTES[list(b'ACGTacgt-')] = False
+N_BYTES = np.zeros(256, dtype=bool)
+N_BYTES[list(b'Nn')] = True
+GAP_BYTE = ord('-')
+# bytes.translate table for uppercasing sequences
+UPPER_TABLE = bytes.maketrans(b'abcdefghijklmnopqrstuvwxyz', b'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+# Approximate size in bytes of record-aligned FASTA blocks
+FASTA_BLOCK_SIZE = 1 << 25
+
+COMPRESSION_MAGIC = {
+    'xz': b'\xfd7zXZ\x00',
+    'zstd': b'\x28\xb5\x2f\xfd',
+    'gzip': b'\x1f\x8b',
+}
+# External decompressors to try in order of preference for each compression format
+DECOMPRESSORS = {
+    'xz': [('xz', ['-dc', '-T{threads}'])],
+    'zstd': [('zstd', ['-dc', '-T{threads}'])],
+    'gzip': [('pigz', ['-dc', '-p', '{threads}']), ('gzip', ['-dc'])],
+}
+
+
+def iter_fasta_blocks(handle: IO[bytes], block_size: int = FASTA_BLOCK_SIZE) -> Iterator[bytes]:
+    """Read FASTA from a binary file handle in blocks of at least `block_size` bytes ending at record boundaries"""
+    remainder = b''
+    while True:
+        data = handle.read(block_size)
+        if not data:
+            break
+        data = remainder + data
+        cut = data.rfind(b'\n>')
+        if cut == -1:
+            remainder = data
+            continue
+        yield data[:cut + 1]
+        remainder = data[cut + 1:]
+    if remainder:
+        yield remainder
+
+
+def parse_fasta_block(block: bytes) -> Iterator[Tuple[str, bytes]]:
+    """Parse FASTA records from a block of bytes, skipping any text before the first record
+
+    All whitespace is removed from sequences.
+    """
+    if block[:1] != b'>':
+        start = block.find(b'\n>')
+        if start == -1:
+            return
+        block = block[start + 1:]
+    for record in block[1:].split(b'\n>'):
+        header, _, seq = record.partition(b'\n')
+        yield header.decode().rstrip(), seq.translate(None, b' \t\r\n')
+
+
+def sequence_stats(seq: bytes) -> Tuple[int, int, int, int]:
+    """Get length, number of ambiguous bases (including N), number of N and number of gaps in a sequence
+
+    Counts all byte values in one pass and sums the counts through a 256-entry lookup table rather than
+    checking each character in Python.
+    """
+    counts = np.bincount(np.frombuffer(seq, dtype=np.uint8), minlength=256)
+    return (
+        len(seq),
+        int(counts[AMBIGUOUS_BYTES].sum()),
+        int(counts[N_BYTES].sum()),
+        int(counts[GAP_BYTE]),
+    )
+
+
+def detect_compression(path: Path) -> Optional[str]:
+    with open(path, 'rb') as fh:
+        magic = fh.read(6)
+    for compression, prefix in COMPRESSION_MAGIC.items():
+        if magic.startswith(prefix):
+            return compression
+    return None
+
+
+@contextmanager
+def open_decompressed(path: Path, threads: int = 1) -> Iterator[IO[bytes]]:
+    """Open file for reading decompressed bytes
+
+    Decompression is piped through an external (multithreaded) decompressor if one is available on PATH,
+    otherwise Python's `lzma` or `gzip` modules, or the `zstandard` package are used.
+    """
+    compression = detect_compression(path)
+    if compression is None:
+        with open(path, 'rb') as fh:
+            yield fh
+        return
+    for exe, args in DECOMPRESSORS[compression]:
+        if shutil.which(exe):
+            cmd = [exe] + [x.format(threads=threads) for x in args] + [str(path)]
+            with pipe_command(cmd) as fh:
+                yield fh
+            return
+    if compression == 'xz':
+        with lzma.open(path) as fh:
+            yield fh
+    elif compression == 'gzip':
+        with gzip.open(path) as fh:
+            yield fh
+    else:
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError(f'Cannot decompress "{path}". The "zstd" executable must be on PATH or the '
+                               f'"zstandard" Python package must be installed to read Zstandard compressed files.')
+        with open(path, 'rb') as fin, zstandard.ZstdDecompressor().stream_reader(fin) as reader:
+            yield io.BufferedReader(reader, buffer_size=FASTA_BLOCK_SIZE)
+
+
+@contextmanager
+def pipe_command(cmd: List[str]) -> Iterator[IO[bytes]]:
+    """Read stdout of a command, raising an error if it fails
+
+    If the output is read to the end, the exit status of the command is checked. If the reader stops before the end
+    of the output or raises an error, the command is terminated instead.
+    """
+    logging.info(f'Decompressing with command: {" ".join(cmd)}')
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=FASTA_BLOCK_SIZE)
+    stopped_early = True
+    try:
+        yield proc.stdout
+        stopped_early = proc.stdout.read(1) != b''
+    finally:
+        if stopped_early:
+            proc.terminate()
+        proc.stdout.close()
+        returncode = proc.wait()
+    if not stopped_early and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+def peek_stream(fh: IO[bytes], size: int) -> Tuple[bytes, IO[bytes]]:
+    """Read the first `size` bytes of a stream and get a stream that still starts with those bytes"""
+    head = read_exactly(fh, size)
+    return head, io.BufferedReader(PrefixedStream(head, fh), buffer_size=FASTA_BLOCK_SIZE)
+
+
+def read_exactly(fh: IO[bytes], size: int) -> bytes:
+    """Read up to `size` bytes from a stream, only reading less if the end of the stream is reached"""
+    chunks = []
+    while size > 0:
+        chunk = fh.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+class PrefixedStream(io.RawIOBase):
+    """Raw stream of some already read bytes followed by the rest of a stream"""
+
+    def __init__(self, prefix: bytes, fh: IO[bytes]):
+        self.prefix = prefix
+        self.fh = fh
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self.prefix:
+            n = min(len(buffer), len(self.prefix))
+            buffer[:n] = self.prefix[:n]
+            self.prefix = self.prefix[n:]
+            return n
+        data = self.fh.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def imap_ordered(pool, func: Callable, tasks: Iterable, max_pending: int) -> Iterator:
+    """Like `Pool.imap` but only consumes `tasks` as results are consumed to bound memory usage"""
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
@@ -4,9 +4,11 @@ from pathlib import Path
 
 import pandas as pd
 import typer
-from Bio import Phylo
 from rich.logging import RichHandler
 
+from aa_mutation_matrix import read_aa_mutation_matrix
+from tree_arrays import read_newick
+
 
 def main(
         newick_tree_input: Path,
@@ -25,16 +27,16 @@ def main(
     )
     df_lineage_report = pd.read_csv(lineage_report, index_col=0)
     if aa_mutation_matrix:
-        df_aa_change = pd.read_table(aa_mutation_matrix, index_col=0)
+        df_aa_change = read_aa_mutation_matrix(aa_mutation_matrix)
         df_out = pd.concat([df_lineage_report, df_aa_change], axis=1)
     else:
         df_out = df_lineage_report
     df_out.to_csv(metadata_output, sep='\t', index=True)
 
-    tree = Phylo.read(newick_tree_input, 'newick')
+    tree = read_newick(newick_tree_input)
     with open(leaflist, 'w') as fout:
-        for node in tree.get_terminals():
-            fout.write(f'{node.name}\n')
+        for name in tree.tip_names():
+            fout.write(f'{name}\n')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,194 @@
+"""Lightweight Newick tree parsing into flat NumPy arrays shared by prune_tree.py and shiptv_metadata.py
+
+Nodes are numbered in preorder so that the root is node 0, each node comes after its parent and the subtree of a node
+is a contiguous range of nodes.
+"""
+import re
+from pathlib import Path
+from typing import List, Optional, NamedTuple, Dict, Iterator
+
+import numpy as np
+
+NEWICK_TOKENS = re.compile(r"'(?:[^']|'')*'|\[[^\]]*\]|[(),:;]|[^(),:;\['\s]+")
+# Characters that require a node name to be quoted in Newick output
+NEWICK_SPECIAL_CHARS = re.compile(r"[(),:;\[\]'\s]")
+
+
+class TreeArrays(NamedTuple):
+    """Tree with node names, parent indices (-1 for root), branch lengths (NaN if missing) and tip flags"""
+    names: List[Optional[str]]
+    parent: np.ndarray
+    branch_length: np.ndarray
+    is_tip: np.ndarray
+
+    @property
+    def n_tips(self) -> int:
+        return int(self.is_tip.sum())
+
+    def tip_names(self) -> List[str]:
+        return [self.names[i] for i in np.flatnonzero(self.is_tip)]
+
+    def tip_index(self) -> Dict[str, int]:
+        return {self.names[i]: i for i in np.flatnonzero(self.is_tip).tolist()}
+
+
+def read_newick(path: Path) -> TreeArrays:
+    with open(path) as fh:
+        return parse_newick(fh.read())
+
+
+def parse_newick(newick: str) -> TreeArrays:
+    """Parse the first tree in a Newick string into preorder node arrays
+
+    Comments in square brackets are skipped and quoted names are unquoted.
+    """
+    names: List[Optional[str]] = []
+    parents: List[int] = []
+    lengths: List[float] = []
+    stack: List[int] = []
+    node = -1
+    new_node = True
+    is_length = False
+    for m in NEWICK_TOKENS.finditer(newick):
+        token = m.group()
+        if token[0] == '[':
+            continue
+        if token == ';':
+            break
+        if token == '(':
+            stack.append(add_node(names, parents, lengths, stack, None))
+            new_node = True
+            continue
+        if token in ',)':
+            if new_node:
+                # unnamed tip without branch length
+                add_node(names, parents, lengths, stack, None)
+            node = stack.pop() if token == ')' else -1
+            new_node = token == ','
+            is_length = False
+            continue
+        if token == ':':
+            is_length = True
+            if new_node:
+                node = add_node(names, parents, lengths, stack, None)
+                new_node = False
+            continue
+        if is_length:
+            lengths[node] = float(token)
+            is_length = False
+        elif new_node:
+            node = add_node(names, parents, lengths, stack, unquote(token))
+            new_node = False
+        else:
+            names[node] = unquote(token)
+    parent = np.array(parents, dtype=np.int64)
+    is_tip = np.ones(parent.size, dtype=bool)
+    is_tip[parent[parent >= 0]] = False
+    return TreeArrays(names, parent, np.array(lengths, dtype=float), is_tip)
+
+
+def add_node(
+        names: List[Optional[str]],
+        parents: List[int],
+        lengths: List[float],
+        stack: List[int],
+        name: Optional[str]
+) -> int:
+    parents.append(stack[-1] if stack else -1)
+    names.append(name)
+    lengths.append(np.nan)
+    return len(names) - 1
+
+
+def unquote(name: str) -> str:
+    if name[0] == "'" and name[-1] == "'":
+        return name[1:-1].replace("''", "'")
+    return name
+
+
+def quote(name: str) -> str:
+    if NEWICK_SPECIAL_CHARS.search(name):
+        return "'" + name.replace("'", "''") + "'"
+    return name
+
+
+def parse_confidence(name: str) -> Optional[float]:
+    try:
+        return float(name)
+    except ValueError:
+        return None
+
+
+def children_lists(parent: np.ndarray) -> List[List[int]]:
+    children: List[List[int]] = [[] for _ in range(parent.size)]
+    for i, p in enumerate(parent.tolist()):
+        if p >= 0:
+            children[p].append(i)
+    return children
+
+
+def iter_newick(tree: TreeArrays) -> Iterator[str]:
+    """Get Newick string pieces for a tree in preorder arrays
+
+    Output is formatted like Biopython `Phylo.write(tree, path, "newick", format_branch_length="%s")`: numeric
+    internal node labels are written as support values with 2 decimals and missing branch lengths as 0.0.
+    """
+    children = children_lists(tree.parent)
+    # stack of (node, whether the children of node have been written)
+    stack = [(0, False)]
+    while stack:
+        i, closed = stack.pop()
+        if i == -1:
+            yield ','
+            continue
+        if not closed and children[i]:
+            yield '('
+            stack.append((i, True))
+            for j, child in enumerate(reversed(children[i])):
+                stack.append((child, False))
+                if j < len(children[i]) - 1:
+                    stack.append((-1, False))
+            continue
+        if children[i]:
+            yield ')'
+        name = tree.names[i]
+        if name is not None:
+            confidence = parse_confidence(name) if children[i] else None
+            yield quote(name) if confidence is None else f'{confidence:.2f}'
+        length = tree.branch_length[i]
+        yield f':{0.0 if np.isnan(length) else length}'
+    yield ';\n'
+
+
+def write_newick(tree: TreeArrays, path: Path) -> None:
+    with open(path, 'w') as fout:
+        fout.write(''.join(iter_newick(tree)))
+
+
+def add_tip_children(tree: TreeArrays, node_children: Dict[int, List[str]]) -> TreeArrays:
+    """Add zero length branch tips with the specified names as the only children of tip nodes
+
+    Each tip becomes an unnamed internal node. Nodes are renumbered to keep preorder numbering.
+    """
+    n_added = np.zeros(tree.parent.size, dtype=np.int64)
+    for i, names in node_children.items():
+        n_added[i] = len(names)
+    # new index of each existing node is shifted by the number of nodes added before it
+    new_index = np.arange(tree.parent.size) + np.concatenate([[0], np.cumsum(n_added)[:-1]])
+    n = tree.parent.size + int(n_added.sum())
+    parent = np.empty(n, dtype=np.int64)
+    parent[new_index] = np.where(tree.parent >= 0, new_index[tree.parent], -1)
+    branch_length = np.zeros(n, dtype=float)
+    branch_length[new_index] = tree.branch_length
+    is_tip = np.ones(n, dtype=bool)
+    is_tip[new_index] = tree.is_tip
+    names: List[Optional[str]] = [None] * n
+    for i, name in zip(new_index.tolist(), tree.names):
+        names[i] = name
+    for i, child_names in node_children.items():
+        start = new_index[i] + 1
+        parent[start:start + len(child_names)] = new_index[i]
+        names[start:start + len(child_names)] = child_names
+        names[new_index[i]] = None
+        is_tip[new_index[i]] = False
+    return TreeArrays(names, parent, branch_length, is_tip)
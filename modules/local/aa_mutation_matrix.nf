@@ -21,10 +21,15 @@ process AA_MUTATION_MATRIX {
   path (metadata)
 
   output:
-  path "aa_mutation_matrix.tsv"
+  path "aa_mutation_matrix.npz", emit: npz
+  path "aa_mutation_matrix.tsv", optional: true, emit: tsv
 
   script:  // This script is bundled with the pipeline, in /bin folder
+  def tsv_output = (params.aa_mutation_matrix_tsv) ? "--tsv-output aa_mutation_matrix.tsv" : ""
   """
-  aa_mutation_matrix.py $metadata aa_mutation_matrix.tsv
+  aa_mutation_matrix.py \\
+    $metadata \\
+    --sparse-output aa_mutation_matrix.npz \\
+    $tsv_output
   """
 }
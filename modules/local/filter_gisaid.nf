@@ -4,6 +4,13 @@ include { initOptions; saveFiles; getSoftwareName } from './functions'
 params.options = [:]
 options        = initOptions(params.options)
 
+// GISAID cache directory resolved against the launch directory rather than the task work directory so that it is
+// shared between runs
+gisaid_cache_dir = (params.gisaid_cache_dir) ? file(params.gisaid_cache_dir).toAbsolutePath() : null
+if (gisaid_cache_dir) {
+  gisaid_cache_dir.mkdirs()
+}
+
 process FILTER_GISAID {
   label 'process_high_mem'
   publishDir "${params.outdir}",
@@ -16,6 +23,10 @@ process FILTER_GISAID {
   } else {
     container 'quay.io/biocontainers/shiptv:0.4.1--pyh5e36f6f_0'
   }
+  // mount the GISAID cache directory at the same path in the container so that the cache persists between runs
+  if (gisaid_cache_dir) {
+    containerOptions (workflow.containerEngine == 'singularity' ? "-B ${gisaid_cache_dir}" : "-v ${gisaid_cache_dir}:${gisaid_cache_dir}")
+  }
 
   input:
   path(sequences)
@@ -28,6 +39,7 @@ process FILTER_GISAID {
   path 'gisaid_metadata.filtered.tsv'   , emit: metadata
   path 'gisaid_metadata.nextstrain.tsv' , emit: nextstrain_metadata
   path 'gisaid_filtering_stats.json'    , emit: stats
+  path 'gisaid_sequences.stats.tsv'     , emit: seq_stats
   path 'filter_gisaid.py.log'           , emit: log
 
   script:  // This script is bundled with the pipeline, in /bin folder
@@ -36,6 +48,8 @@ process FILTER_GISAID {
   def date_start = (params.gisaid_date_start) ? "--date-start ${params.gisaid_date_start}" : ""
   def date_end = (params.gisaid_date_end) ? "--date-end ${params.gisaid_date_end}" : ""
   def pangolin_lineages = (params.gisaid_pangolin_lineages) ? "--pangolin-lineages ${params.gisaid_pangolin_lineages}" : ""
+  def cache_dir = (gisaid_cache_dir) ? "--cache-dir ${gisaid_cache_dir}" : ""
+  def low_memory = (params.gisaid_low_memory) ? "--low-memory" : ""
   """
   filter_gisaid.py \\
     $sequences \\
@@ -46,11 +60,13 @@ process FILTER_GISAID {
     --max-length ${params.gisaid_max_length} \\
     --max-ambig ${params.gisaid_max_ambig} \\
     --max-gisaid-seqs ${params.max_gisaid_filtered_seqs} \\
-    $region_args $country_args $date_start $date_end $pangolin_lineages \\
+    --threads ${task.cpus} \\
+    $region_args $country_args $date_start $date_end $pangolin_lineages $cache_dir $low_memory \\
     --fasta-output gisaid_sequences.filtered.fasta \\
     --filtered-metadata gisaid_metadata.filtered.tsv \\
     --nextstrain-metadata gisaid_metadata.nextstrain.tsv \\
     --statistics-output gisaid_filtering_stats.json \\
+    --sequence-stats-output gisaid_sequences.stats.tsv \\
     2>&1 | tee -a filter_gisaid.py.log
   """
 }
@@ -26,9 +26,12 @@ process FILTER_MSA {
   output:
   path "msa.filtered.fasta", emit: fasta
   path "metadata.msa.tsv"  , emit: metadata
+  path "msa.groups.tsv"    , emit: groups
   path "filter_msa.py.log" , emit: log
 
   script:  // This script is bundled with the pipeline, in /bin folder
+  def collapse_identical = (params.collapse_identical_seqs) ? "--collapse-identical" : ""
+  def adaptive_quality = (params.msa_adaptive_quality) ? "--adaptive-quality" : "--no-adaptive-quality"
   """
   filter_msa.py \\
     --input-fasta $msa \\
@@ -39,6 +42,10 @@ process FILTER_MSA {
     --max-seqs ${params.max_msa_seqs} \\
     --output-fasta msa.filtered.fasta \\
     --output-metadata metadata.msa.tsv \\
+    --quality-percentile ${params.msa_quality_percentile} \\
+    $adaptive_quality \\
+    $collapse_identical \\
+    --groups-output msa.groups.tsv \\
     2>&1 | tee -a filter_msa.py.log
   """
 }
@@ -21,6 +21,7 @@ process MERGE_METADATA{
   path(aa_mutation_matrix)
   path(pangolin_report)
   path(user_metadata)
+  path(leaflist)
 
   output:
   path "metadata.merged.tsv"
@@ -34,6 +35,7 @@ process MERGE_METADATA{
     $gisaid_metadata \\
     $pangolin_report \\
     $aa_mutation_matrix_opt $select_metadata_fields $user_metadata_opt \\
+    --leaflist $leaflist \\
     --metadata-output metadata.merged.tsv
   """
 }
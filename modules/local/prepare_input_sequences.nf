@@ -23,11 +23,21 @@ process PREPARE_INPUT_SEQUENCES {
 
   output:
   path 'input_sequences.correctedID.fasta' , emit: fasta
+  path 'input_sequences.duplicate_ids.tsv'  , emit: duplicates
+  path 'input_sequences.qc.tsv'             , emit: qc
 
   script:
+  def max_ambig = (params.input_max_ambig) ? "--max-ambig ${params.input_max_ambig}" : ""
+  def drop_failed = (params.drop_failed_input_seqs) ? "--drop-failed" : ""
   """
   prepare_input_sequences.py \\
       $fasta \\
-      --fasta-output input_sequences.correctedID.fasta
+      --fasta-output input_sequences.correctedID.fasta \\
+      --duplicates-output input_sequences.duplicate_ids.tsv \\
+      --qc-output input_sequences.qc.tsv \\
+      --min-length ${params.input_min_length} \\
+      --max-n-fraction ${params.input_max_n_fraction} \\
+      $max_ambig $drop_failed \\
+      --threads ${task.cpus}
   """
 }
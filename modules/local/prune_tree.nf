@@ -22,10 +22,12 @@ process PRUNE_TREE {
   path (newick)
   path (pangolin_report)
   path (metadata)
+  path (groups)
 
   output:
   path "leaflist"             , emit: leaflist
   path "metadata.leaflist.tsv", emit: metadata
+  path "tree.expanded.treefile", emit: newick
 
   script:  // This script is bundled with the pipeline, in /bin folder
   """
@@ -36,6 +38,10 @@ process PRUNE_TREE {
     --ref-name ${params.reference_name} \\
     --leaflist leaflist \\
     --metadata-output metadata.leaflist.tsv \\
-    --max-taxa ${params.max_taxa}
+    --groups $groups \\
+    --tree-output tree.expanded.treefile \\
+    --max-taxa ${params.max_taxa} \\
+    --max-neighbors-per-taxon ${params.max_neighbors_per_taxon} \\
+    --selection-mode ${params.tree_selection_mode}
   """
 }
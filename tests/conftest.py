@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# pipeline scripts in bin/ import their helper modules as siblings
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'bin'))
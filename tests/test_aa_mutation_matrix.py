@@ -0,0 +1,72 @@
+import io
+import json
+
+import pytest
+
+from aa_mutation_matrix import (build_aa_mutation_matrix, iter_nextclade_aa_mutations, read_aa_mutation_matrix,
+                                write_dense_tsv, write_sparse_matrix)
+
+# sample "b" occurs twice and only its last AA mutations are kept
+SAMPLE_AAS = [
+    ('a', ['S:N501Y', 'ORF1a:S3675-']),
+    ('b', ['S:D614G', 'N:R203K', 'S:Y144-']),
+    ('c', []),
+    ('b', ['S:N501Y']),
+]
+
+
+def test_build_aa_mutation_matrix_duplicate_sample(tmp_path):
+    indptr, indices, samples, unique_aas = build_aa_mutation_matrix(SAMPLE_AAS)
+    assert samples == ['a', 'b', 'c']
+    # AA mutations only found in the replaced row of "b" do not get a column
+    assert unique_aas == ['ORF1a:S3675-', 'S:N501Y']
+    assert indptr.tolist() == [0, 2, 3, 3]
+    assert indices.tolist() == [0, 1, 1]
+    path = tmp_path / 'aa.npz'
+    write_sparse_matrix(path, indptr, indices, samples, unique_aas)
+    df = read_aa_mutation_matrix(path)
+    assert df.values.tolist() == [[1, 1], [0, 1], [0, 0]]
+
+
+def write_nextclade_table(path, sep):
+    rows = ['seqName', 'clade', 'aaSubstitutions', 'aaDeletions']
+    lines = [sep.join(rows)]
+    for sample, aas in SAMPLE_AAS:
+        subs = ','.join(aa for aa in aas if not aa.endswith('-'))
+        dels = ','.join(aa for aa in aas if aa.endswith('-'))
+        lines.append(sep.join([sample, '20A', subs, dels]))
+    path.write_text('\n'.join(lines) + '\n')
+
+
+def write_nextclade_ndjson(path):
+    lines = []
+    for sample, aas in SAMPLE_AAS:
+        subs = []
+        dels = []
+        for aa in aas:
+            gene, mutation = aa.split(':')
+            ref, pos, alt = mutation[0], int(mutation[1:-1]) - 1, mutation[-1]
+            if alt == '-':
+                dels.append({'gene': gene, 'codon': pos, 'refAA': ref})
+            else:
+                subs.append({'gene': gene, 'codon': pos, 'refAA': ref, 'queryAA': alt})
+        lines.append(json.dumps({'seqName': sample, 'aaSubstitutions': subs, 'aaDeletions': dels}))
+    path.write_text('\n'.join(lines) + '\n')
+
+
+@pytest.mark.parametrize('filename', ['nextclade.csv', 'nextclade.tsv', 'nextclade.ndjson'])
+def test_nextclade_results_duplicate_sample(tmp_path, filename):
+    path = tmp_path / filename
+    if path.suffix == '.ndjson':
+        write_nextclade_ndjson(path)
+    else:
+        write_nextclade_table(path, ';' if path.suffix == '.csv' else '\t')
+    # chunks smaller than the number of results so that the duplicate sample is in another chunk
+    indptr, indices, samples, unique_aas = build_aa_mutation_matrix(iter_nextclade_aa_mutations(path, chunksize=2))
+    assert samples == ['a', 'b', 'c']
+    assert unique_aas == ['ORF1a:S3675-', 'S:N501Y']
+    assert indptr.tolist() == [0, 2, 3, 3]
+    assert indices.tolist() == [0, 1, 1]
+    fout = io.BytesIO()
+    write_dense_tsv(fout, indptr, indices, samples, unique_aas)
+    assert fout.getvalue() == b'\tORF1a:S3675-\tS:N501Y\na\t1\t1\nb\t0\t1\nc\t0\t0\n'
@@ -0,0 +1,16 @@
+import pandas as pd
+
+from filter_msa import GROUPS_COLUMNS, identical_sequence_groups
+
+
+def test_identical_sequence_groups_keeps_preferred_samples():
+    df_msa = pd.DataFrame(dict(
+        record=[0, 1, 2, 3, 4, 5],
+        digest=[b'a', b'b', b'a', b'a', b'b', b'c'],
+        seq_n=0,
+        seq_gap=0,
+    ), index=['gisaid1', 'gisaid2', 'MN908947.3', 'user1', 'gisaid3', 'user2'])
+    df_groups = identical_sequence_groups(set(df_msa.index), {'MN908947.3', 'user1', 'user2'}, df_msa)
+    assert list(df_groups.columns) == GROUPS_COLUMNS
+    # user1 is identical to the reference but is not collapsed into it
+    assert sorted(map(tuple, df_groups.values.tolist())) == [('MN908947.3', 'gisaid1'), ('gisaid2', 'gisaid3')]
@@ -0,0 +1,29 @@
+import io
+
+import numpy as np
+import pytest
+
+from tree_arrays import add_tip_children, iter_newick, parse_newick, read_newick, write_newick
+
+NEWICK = "((a:0.1,'b c':0)55:0.2,(d:1e-7,e:0.00012345678912)abc:0,(f:3,'g''h')0.9)90;"
+
+
+def test_write_newick_round_trip(tmp_path):
+    tree = parse_newick(NEWICK)
+    tree = add_tip_children(tree, {tree.tip_index()['d']: ['d', 'd2']})
+    path = tmp_path / 'tree.nwk'
+    write_newick(tree, path)
+    tree2 = read_newick(path)
+    assert tree2.parent.tolist() == tree.parent.tolist()
+    assert tree2.is_tip.tolist() == tree.is_tip.tolist()
+    assert tree2.tip_names() == ['a', 'b c', 'd', 'd2', 'e', 'f', "g'h"]
+    # missing branch lengths are written as 0.0
+    assert np.array_equal(tree2.branch_length, np.nan_to_num(tree.branch_length))
+    assert [tree2.names[i] for i in np.flatnonzero(~tree2.is_tip)] == ['90.00', '55.00', 'abc', None, '0.90']
+
+
+def test_write_newick_matches_biopython():
+    Phylo = pytest.importorskip('Bio.Phylo')
+    fout = io.StringIO()
+    Phylo.write(Phylo.read(io.StringIO(NEWICK), 'newick'), fout, 'newick', format_branch_length='%s')
+    assert ''.join(iter_newick(parse_newick(NEWICK))) == fout.getvalue()
@@ -39,7 +39,8 @@ workflow PHYLOGENETIC_ANALYSIS {
         PREPARE_INPUT_SEQUENCES.out.fasta,
         'csv'
     )
-    AA_MUTATION_MATRIX(NEXTCLADE.out.csv).set { ch_aa_mutation_matrix }
+    AA_MUTATION_MATRIX(NEXTCLADE.out.csv)
+    AA_MUTATION_MATRIX.out.npz.set { ch_aa_mutation_matrix }
   }
   SHIPTV_METADATA(
       IQTREE.out.treefile,
@@ -56,7 +57,7 @@ workflow PHYLOGENETIC_ANALYSIS {
     ALIGN2ALLELES(MAFFT.out.fasta)
     PHYLOGENETICTREE_SNPS(
         IQTREE.out.treefile,
-        ALIGN2ALLELES.out,
+        ALIGN2ALLELES.out.sparse,
         PANGOLIN.out.report
     )
   }
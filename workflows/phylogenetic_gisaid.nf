@@ -55,7 +55,8 @@ workflow PHYLOGENETIC_GISAID {
   PRUNE_TREE(
     IQTREE.out.treefile,
     PANGOLIN.out.report,
-    FILTER_MSA.out.metadata
+    FILTER_MSA.out.metadata,
+    FILTER_MSA.out.groups
   )
 
   ch_aa_mutation_matrix = Channel.empty()
@@ -68,16 +69,17 @@ workflow PHYLOGENETIC_GISAID {
     NEXTCLADE(SEQUENCES_NEXTCLADE.out, 'csv')
     ch_software_versions = ch_software_versions.mix(NEXTCLADE.out.version.ifEmpty(null))
     AA_MUTATION_MATRIX(NEXTCLADE.out.csv)
-    AA_MUTATION_MATRIX.out.set { ch_aa_mutation_matrix }
+    AA_MUTATION_MATRIX.out.npz.set { ch_aa_mutation_matrix }
   }
   MERGE_METADATA(
     PRUNE_TREE.out.metadata,
     ch_aa_mutation_matrix.ifEmpty([]),
     PANGOLIN.out.report,
-    ch_input_metadata.ifEmpty([])
+    ch_input_metadata.ifEmpty([]),
+    PRUNE_TREE.out.leaflist
   )
   SHIPTV(
-    IQTREE.out.treefile,
+    PRUNE_TREE.out.newick,
     PRUNE_TREE.out.leaflist,
     MERGE_METADATA.out
   )